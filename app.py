@@ -1,4 +1,10 @@
-from grocerystore import app
+from grocerystore import create_app
+from grocerystore.migrations import upgrade
+
+app = create_app()
 
 if __name__ == "__main__":
+    # Create or upgrade the database when running the development server
+    with app.app_context():
+        upgrade()
     app.run()
@@ -0,0 +1,7 @@
+from grocerystore.asgi import create_asgi_app
+
+# The store in async mode, for an ASGI server. It needs aiosqlite (or the async
+# driver of the database) and a server such as uvicorn:
+#   uvicorn asgi:app
+# The database must be created or upgraded first, e.g. with 'flask db upgrade'.
+app = create_asgi_app()
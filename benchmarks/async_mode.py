@@ -0,0 +1,290 @@
+# Side by side load test of the sync and async serving modes. Seeds a
+# temporary SQLite database, then serves it from one server process at a time:
+# the Flask app on Werkzeug's threaded server, as app.py runs it, with a thread
+# per request, and the ASGI app of asgi.py on uvicorn. Thousands of shoppers
+# sign in, then browse the catalog, their cart and their orders with a pause
+# between pages, keeping their connection open when the server allows it
+# (Werkzeug closes every connection after one response). Reports throughput,
+# latency percentiles, and the server's threads and memory per shopper.
+#
+#   python benchmarks/async_mode.py                          # 2000 shoppers, both modes
+#   python benchmarks/async_mode.py --shoppers 4000 --ramp 120
+#   python benchmarks/async_mode.py --modes async
+#
+# The async mode needs aiosqlite and uvicorn. Memory is read from /proc, so it
+# is only reported on Linux. The clients run in this process on the same
+# machine, so compare the modes with each other rather than with other machines.
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections import defaultdict
+
+parser = argparse.ArgumentParser(description='Compare the sync and async serving modes under many open connections.')
+parser.add_argument('--modes', default='sync,async', help='Modes to run, of sync and async.')
+parser.add_argument('--shoppers', type=int, default=2000, help='Shoppers connected at the same time.')
+parser.add_argument('--think', type=float, default=60.0, help='Average seconds a shopper spends on a page.')
+parser.add_argument('--ramp', type=float, default=60.0, help='Seconds over which the shoppers arrive.')
+parser.add_argument('--duration', type=float, default=60.0, help='Seconds measured once every shopper is browsing.')
+parser.add_argument('--categories', type=int, default=50, help='Seeded categories.')
+parser.add_argument('--products', type=int, default=10000, help='Seeded products.')
+parser.add_argument('--orders', type=int, default=5000, help='Seeded historic orders.')
+args = parser.parse_args()
+
+# Use a throwaway database, set before the app is created. Every shopper signs
+# in from the same address, so the rate limits are off.
+directory = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+os.environ['AUTH_RATE_LIMIT'] = '0'
+os.environ['ACCOUNT_RATE_LIMIT'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grocerystore import create_app, db
+from grocerystore.migrations import upgrade
+from seed import seed, PASSWORD
+
+# Open files allowed per process, raised so thousands of connections fit
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Serve the Flask app with a thread per connection, like app.run()
+def serve_sync(sock):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app = create_app({'WTF_CSRF_ENABLED': False})
+    make_server('127.0.0.1', 0, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+# Serve the ASGI app on one event loop
+def serve_async(sock):
+    import uvicorn
+    from grocerystore.asgi import create_asgi_app
+    store = create_asgi_app({'WTF_CSRF_ENABLED': False})
+    # Idle connections are kept as long as a browser would keep them
+    uvicorn.Server(uvicorn.Config(store, log_level='warning', backlog=args.shoppers, timeout_keep_alive=75)).run(sockets=[sock])
+
+def serve(mode, sock):
+    raise_file_limit()
+    {'sync': serve_sync, 'async': serve_async}[mode](sock)
+
+# Resident memory in KB and threads of a process, from /proc on Linux
+def process_status(pid):
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            fields = dict(line.split(':', 1) for line in file)
+    except OSError:
+        return None, None
+    return int(fields['VmRSS'].split()[0]), int(fields['Threads'])
+
+# An HTTP/1.1 connection kept open by one shopper, with its session cookie
+class Connection:
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+        self.cookie = None
+
+    async def request(self, method, path, data=None):
+        reused = self.writer is not None
+        if not reused:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        body = urllib.parse.urlencode(data).encode() if data is not None else b''
+        head = [f'{method} {path} HTTP/1.1', f'Host: 127.0.0.1:{self.port}', f'Content-Length: {len(body)}']
+        if data is not None:
+            head.append('Content-Type: application/x-www-form-urlencoded')
+        if self.cookie:
+            head.append(f'Cookie: {self.cookie}')
+        try:
+            self.writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+        except ConnectionError:
+            status_line = b''
+        # The server closed an idle connection, so like a browser try again on a new one
+        if not status_line and reused:
+            self.close()
+            return await self.request(method, path, data)
+
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'set-cookie' and value.startswith('session='):
+                self.cookie = value.split(';', 1)[0]
+            headers[name] = value
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+# Latencies of each page, and failures, counted during the measured window
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.measuring = False
+
+    def add(self, name, seconds, failed):
+        if self.measuring:
+            self.latencies[name].append(seconds * 1000)
+            if failed:
+                self.errors[name] += 1
+
+# One shopper: arrive, sign in and browse until the end, pausing on each page
+async def shopper(number, port, results, stop, arrival):
+    rng = random.Random(number)
+    await asyncio.sleep(arrival)
+    connection = Connection(port)
+    try:
+        status = await connection.request('POST', '/login', {'email': f'user{number}@example.com', 'password': PASSWORD})
+        if status != 302:
+            raise RuntimeError(f'user{number} could not log in ({status})')
+        while not stop.is_set():
+            category = rng.randint(1, args.categories)
+            product = rng.randint(1, args.products)
+            for name, path in (('home', '/home'), ('view_category', f'/category/{category}'), ('view_product', f'/product/{product}'), ('view_cart', '/cart'), ('orders', '/orders')):
+                start = time.perf_counter()
+                try:
+                    failed = await connection.request('GET', path) >= 400
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    connection.close()
+                    failed = True
+                results.add(name, time.perf_counter() - start, failed)
+                try:
+                    await asyncio.wait_for(stop.wait(), rng.expovariate(1 / args.think))
+                    return
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        connection.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+# Run every shopper against a server, sampling its memory and threads
+async def load(pid, port):
+    results = Results()
+    stop = asyncio.Event()
+    idle = process_status(pid)
+    tasks = [asyncio.create_task(shopper(n, port, results, stop, args.ramp * n / args.shoppers)) for n in range(1, args.shoppers + 1)]
+    await asyncio.sleep(args.ramp)
+    results.measuring = True
+    start = time.perf_counter()
+    peak_rss, peak_threads = idle
+    while time.perf_counter() - start < args.duration:
+        await asyncio.sleep(0.5)
+        rss, threads = process_status(pid)
+        if rss is not None:
+            peak_rss, peak_threads = max(peak_rss, rss), max(peak_threads, threads)
+    results.measuring = False
+    elapsed = time.perf_counter() - start
+    stop.set()
+    failures = [result for result in await asyncio.gather(*tasks, return_exceptions=True) if isinstance(result, Exception)]
+    return results, elapsed, idle, (peak_rss, peak_threads), failures
+
+def run(mode):
+    raise_file_limit()
+    # Made with its protocol, so asyncio turns off Nagle's algorithm on its connections as uvicorn's own sockets do
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(args.shoppers)
+    server = multiprocessing.Process(target=serve, args=(mode, sock), daemon=True)
+    server.start()
+    port = sock.getsockname()[1]
+    try:
+        # Wait for the server to answer before the shoppers arrive
+        for _ in range(100):
+            try:
+                asyncio.run(Connection(port).request('GET', '/login'))
+                break
+            except OSError:
+                time.sleep(0.1)
+        return asyncio.run(load(server.pid, port))
+    finally:
+        server.terminate()
+        server.join()
+        sock.close()
+
+def report(mode, results, elapsed, idle, peak, failures):
+    total = sum(len(latencies) for latencies in results.latencies.values())
+    errors = sum(results.errors.values())
+    latencies = [latency for page in results.latencies.values() for latency in page]
+    print(f'\n{mode} mode, {args.shoppers} shoppers')
+    print(f'{"page":<15}{"requests":>9}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"errors":>8}')
+    for name, page in results.latencies.items():
+        print(f'{name:<15}{len(page):>9}{len(page) / elapsed:>9.1f}{percentile(page, 0.50):>9.2f}{percentile(page, 0.95):>9.2f}{percentile(page, 0.99):>9.2f}{results.errors[name]:>8}')
+    print(f'{"all":<15}{total:>9}{total / elapsed:>9.1f}{percentile(latencies, 0.50):>9.2f}{percentile(latencies, 0.95):>9.2f}{percentile(latencies, 0.99):>9.2f}{errors:>8}')
+    if idle[0] is not None:
+        print(f'server: {idle[0] / 1024:.0f} MB before the shoppers, {peak[0] / 1024:.0f} MB at most, '
+              f'{(peak[0] - idle[0]) / args.shoppers:.1f} KB per shopper, {peak[1]} threads at most')
+    if failures:
+        print(f'{len(failures)} shoppers gave up, first with: {failures[0]!r}')
+    return {'throughput': total / elapsed, 'p95_ms': percentile(latencies, 0.95), 'errors': errors,
+            'kb_per_shopper': (peak[0] - idle[0]) / args.shoppers if idle[0] is not None else None, 'threads': peak[1]}
+
+def main():
+    modes = [mode.strip() for mode in args.modes.split(',')]
+    if any(mode not in ('sync', 'async') for mode in modes):
+        parser.error('--modes can only list sync and async')
+    if 'async' in modes:
+        try:
+            import aiosqlite, uvicorn
+        except ImportError as error:
+            parser.error(f'the async mode needs aiosqlite and uvicorn ({error})')
+    print(f'Seeding {args.shoppers} users, {args.categories} categories, {args.products} products and {args.orders} orders...')
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        seed(users=args.shoppers, categories=args.categories, products=args.products, orders=args.orders)
+        # Forked server processes must open their own connections
+        db.engine.dispose()
+
+    summary = {}
+    for mode in modes:
+        print(f'Running {args.shoppers} shoppers against the {mode} mode for {args.ramp + args.duration:.0f}s...')
+        summary[mode] = report(mode, *run(mode))
+
+    if len(summary) > 1:
+        print(f'\n{"mode":<8}{"req/s":>9}{"p95 ms":>9}{"errors":>8}{"KB/shopper":>11}{"threads":>9}')
+        for mode, row in summary.items():
+            memory = f'{row["kb_per_shopper"]:.1f}' if row['kb_per_shopper'] is not None else 'n/a'
+            print(f'{mode:<8}{row["throughput"]:>9.1f}{row["p95_ms"]:>9.2f}{row["errors"]:>8}{memory:>11}{row["threads"] or "n/a":>9}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# Compare the query plans and latency of the hot foreign key lookups before
+# and after the lookup_indexes migration, on a seeded SQLite database.
+#
+#   python benchmarks/lookup_indexes.py [--products 200000] [--users 20000]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark the lookup indexes migration.')
+parser.add_argument('--products', type=int, default=200000)
+parser.add_argument('--categories', type=int, default=500)
+parser.add_argument('--users', type=int, default=20000)
+parser.add_argument('--cart-lines', type=int, default=100000)
+parser.add_argument('--orders', type=int, default=100000, help='Orders of three lines each.')
+parser.add_argument('--repeat', type=int, default=200, help='Times each query is run.')
+args = parser.parse_args()
+
+# Use a throwaway database, set before the app is created
+directory = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+os.environ.setdefault('SECRET_KEY', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from grocerystore import create_app, db
+from grocerystore.models import Product, Cart, Order
+from grocerystore.migrations import upgrade, MIGRATIONS, lookup_indexes
+from grocerystore.catalog import get_category_products
+from grocerystore.carts import get_cart
+from seed import seed
+
+app = create_app()
+
+# Sample arguments, the same for both runs
+def samples():
+    random.seed(2)
+    carts = db.session.execute(text('SELECT user_id, product_id FROM cart ORDER BY random() LIMIT :n'), {'n': args.repeat}).all()
+    users = [random.randint(1, args.users) for _ in range(args.repeat)]
+    categories = [random.randint(1, args.categories) for _ in range(args.repeat)]
+    return carts, users, categories
+
+# name, query for the plan, and a function running the query for one sample
+def queries(carts, users, categories):
+    return [
+        ('cart line', Cart.query.filter_by(user_id=1, product_id=1),
+            lambda n: Cart.query.filter_by(user_id=carts[n][0], product_id=carts[n][1]).first()),
+        ('user cart', Cart.query.filter_by(user_id=1),
+            lambda n: get_cart(users[n])),
+        ('user order lines', Order.query.filter_by(user_id=1),
+            lambda n: Order.query.filter_by(user_id=users[n]).all()),
+        ('category products', Product.query.filter_by(category_id=1).order_by(Product.id).limit(13),
+            lambda n: get_category_products(categories[n])),
+    ]
+
+def query_plan(query):
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    return '; '.join(row[3] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+
+def measure(title, samples):
+    print(f'\n{title}')
+    print(f'{"query":<20}{"mean ms":>10}{"p95 ms":>10}  plan')
+    results = {}
+    for name, query, run in queries(*samples):
+        timings = []
+        for n in range(args.repeat):
+            start = time.perf_counter()
+            run(n)
+            timings.append((time.perf_counter() - start) * 1000)
+            db.session.rollback()
+        timings.sort()
+        mean = sum(timings) / len(timings)
+        results[name] = mean
+        print(f'{name:<20}{mean:>10.3f}{timings[int(len(timings) * 0.95)]:>10.3f}  {query_plan(query)}')
+    return results
+
+# Schema versions just before and after the migration
+BEFORE = MIGRATIONS.index(lookup_indexes)
+AFTER = BEFORE + 1
+
+with app.app_context():
+    upgrade(BEFORE)
+    print(f'Seeding {args.products} products, {args.cart_lines} cart lines and {args.orders} orders...')
+    seed(users=args.users, categories=args.categories, products=args.products, orders=args.orders, cart_lines=args.cart_lines)
+    test_samples = samples()
+    before = measure(f'Before lookup_indexes (schema version {BEFORE})', test_samples)
+    upgrade(AFTER)
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    after = measure(f'After lookup_indexes (schema version {AFTER})', test_samples)
+    print('\nSpeedup')
+    for name in before:
+        print(f'{name:<20}{before[name] / after[name]:>9.1f}x')
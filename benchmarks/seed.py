@@ -0,0 +1,68 @@
+# Seed a database with a synthetic store for benchmarks. Every user's password is PASSWORD.
+
+import random
+import sqlalchemy as sa
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert, select, func, text
+from grocerystore import db
+from grocerystore.models import User, Category, Product, Cart, OrderHeader, Order
+from grocerystore.passwords import hash_password
+
+PASSWORD = 'password'
+# Rows inserted per statement
+CHUNK_SIZE = 10000
+
+# Rows are inserted into the tables as they are in the database, not as the
+# models describe them, so benchmarks can seed a database at an older schema version
+def insert_rows(model, rows):
+    table = sa.Table(model.__tablename__, sa.MetaData(), autoload_with=db.session.connection())
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(table), rows[start:start + CHUNK_SIZE])
+
+def next_id(model):
+    return (db.session.scalar(select(func.max(model.id))) or 0) + 1
+
+def seed(users=1000, categories=50, products=10000, orders=5000, lines_per_order=3, cart_lines=0, stock=1000000, random_seed=1):
+    random.seed(random_seed)
+    password = hash_password(PASSWORD)
+
+    first_user = next_id(User)
+    insert_rows(User, [
+        {'name': f'User {n}', 'username': f'user{n}', 'email': f'user{n}@example.com', 'is_admin': False, 'password': password}
+        for n in range(first_user, first_user + users)
+    ])
+    first_category = next_id(Category)
+    insert_rows(Category, [{'name': f'Category {n}'} for n in range(first_category, first_category + categories)])
+    first_product = next_id(Product)
+    prices = [round(random.uniform(1, 500), 2) for _ in range(products)]
+    insert_rows(Product, [
+        {'name': f'Product {first_product + n}', 'price': prices[n], 'category_id': random.randrange(first_category, first_category + categories),
+         'quantity': stock, 'manufacture_date': date(2023, 1, 1)}
+        for n in range(products)
+    ])
+
+    # Orders spread over the last year, each with a few random products
+    first_order = next_id(OrderHeader)
+    headers, lines = [], []
+    start = datetime(2023, 1, 1)
+    for n in range(orders):
+        user_id = random.randrange(first_user, first_user + users)
+        ordered = start + timedelta(seconds=random.randrange(365 * 24 * 3600))
+        total = 0
+        for product in random.sample(range(products), min(lines_per_order, products)):
+            quantity = random.randint(1, 5)
+            total += prices[product] * quantity
+            lines.append({'header_id': first_order + n, 'user_id': user_id, 'product_id': first_product + product,
+                          'quantity': quantity, 'price': prices[product], 'datetime_ordered': ordered})
+        headers.append({'id': first_order + n, 'user_id': user_id, 'total': round(total, 2), 'datetime_ordered': ordered})
+    insert_rows(OrderHeader, headers)
+    insert_rows(Order, lines)
+
+    cart = {(random.randrange(first_user, first_user + users), random.randrange(first_product, first_product + products)) for _ in range(cart_lines)}
+    insert_rows(Cart, [{'user_id': user_id, 'product_id': product_id, 'quantity': 1} for user_id, product_id in cart])
+    db.session.commit()
+
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+    return range(first_user, first_user + users)
@@ -0,0 +1,264 @@
+# Load test of the storefront. Seeds a temporary SQLite database, then has
+# virtual users browse, fill their carts, check out and read their orders,
+# either through the Flask test client or against a local multi-process server.
+# Reports throughput, latency percentiles and SQL queries per request for each
+# page, and compares them with a stored baseline.
+#
+#   python benchmarks/storefront.py                      # compare with baseline.json
+#   python benchmarks/storefront.py --server --processes 4
+#   python benchmarks/storefront.py --save-baseline      # record a new baseline
+#
+# Latency depends on the machine, so record the baseline on the machine that
+# runs the comparison. Query counts don't.
+
+import argparse
+import http.cookiejar
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description='Load test the storefront.')
+parser.add_argument('--users', type=int, default=1000, help='Seeded users.')
+parser.add_argument('--categories', type=int, default=50, help='Seeded categories.')
+parser.add_argument('--products', type=int, default=10000, help='Seeded products.')
+parser.add_argument('--orders', type=int, default=5000, help='Seeded historic orders.')
+parser.add_argument('--virtual-users', type=int, default=4, help='Users browsing at the same time.')
+parser.add_argument('--iterations', type=int, default=25, help='Visits by each virtual user.')
+parser.add_argument('--warmup', type=int, default=2, help='Visits by each virtual user before measuring.')
+parser.add_argument('--server', action='store_true', help='Run against a local server instead of the test client.')
+parser.add_argument('--processes', type=int, default=4, help='Server worker processes.')
+parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline.')
+parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed slowdown against the baseline, as a fraction.')
+args = parser.parse_args()
+
+# Use a throwaway database, set before the app is created
+directory = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+os.environ.setdefault('SECRET_KEY', 'bench')
+# Logins are set up before measuring, so a cheap hash keeps seeding fast
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+from grocerystore import create_app, db
+from grocerystore.migrations import upgrade
+from seed import seed, PASSWORD
+
+# The query count of each request is read from its Server-Timing header. Every
+# virtual user signs in from the same address and changes its cart faster than
+# a shopper would, so the rate limits are off, but they are still checked.
+app = create_app({'WTF_CSRF_ENABLED': False, 'SERVER_TIMING': 'true', 'AUTH_RATE_LIMIT': '0', 'CART_RATE_LIMIT': '0'})
+
+def query_count(headers):
+    match = re.search(r'desc="(\d+) queries"', headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else 0
+
+# Makes requests through the Flask test client
+class TestClient:
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, query_count(response.headers)
+
+# Makes requests over HTTP, keeping cookies and not following redirects
+class HttpClient:
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self.NoRedirect)
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status, query_count(response.headers)
+        except urllib.error.HTTPError as response:
+            response.read()
+            return response.code, query_count(response.headers)
+
+# Latencies and query counts of each page
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name, seconds, status, queries):
+        with self.lock:
+            self.latencies[name].append(seconds * 1000)
+            self.queries[name].append(queries)
+            if status >= 400:
+                self.errors[name] += 1
+
+# One visit to the store: browse, buy a product and look at the orders
+def visit(client, results, categories, products, rng):
+    category = rng.choice(categories)
+    product = rng.choice(products)
+    steps = [
+        ('home', 'GET', '/home', None),
+        ('view_category', 'GET', f'/category/{category}', None),
+        ('view_product', 'GET', f'/product/{product}', None),
+        ('add_to_cart', 'POST', f'/product/{product}/add_to_cart', {'quantity': '1'}),
+        ('view_cart', 'GET', '/cart', None),
+        ('place_order', 'GET', '/cart/order', None),
+        ('orders', 'GET', '/orders', None),
+    ]
+    for name, method, path, data in steps:
+        start = time.perf_counter()
+        status, queries = client.request(method, path, data)
+        if results is not None:
+            results.add(name, time.perf_counter() - start, status, queries)
+
+def virtual_user(number, make_client, results, categories, products):
+    rng = random.Random(number)
+    client = make_client()
+    status, _ = client.request('POST', '/login', {'email': f'user{number}@example.com', 'password': PASSWORD})
+    if status != 302:
+        raise RuntimeError(f'user{number} could not log in ({status})')
+    for _ in range(args.warmup):
+        visit(client, None, categories, products, rng)
+    for _ in range(args.iterations):
+        visit(client, results, categories, products, rng)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def summarize(results, elapsed):
+    summary = {}
+    for name, latencies in results.latencies.items():
+        summary[name] = {
+            'requests': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries': sum(results.queries[name]) / len(latencies),
+            'errors': results.errors[name],
+        }
+    return summary
+
+def report(summary, elapsed):
+    print(f'\n{"page":<15}{"requests":>9}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"errors":>8}')
+    for name, row in summary.items():
+        print(f'{name:<15}{row["requests"]:>9}{row["throughput"]:>9.1f}{row["p50_ms"]:>9.2f}{row["p95_ms"]:>9.2f}{row["p99_ms"]:>9.2f}{row["queries"]:>9.1f}{row["errors"]:>8}')
+    total = sum(row['requests'] for row in summary.values())
+    print(f'\n{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} requests/s')
+
+# List every way the results are worse than the baseline
+def regressions(summary, baseline):
+    found = []
+    for name, expected in baseline['pages'].items():
+        row = summary.get(name)
+        if row is None:
+            found.append(f'{name}: not measured')
+            continue
+        if row['errors']:
+            found.append(f'{name}: {row["errors"]} failed requests')
+        # Cache hits vary a little with the order of requests, an extra query per request doesn't
+        if row['queries'] > expected['queries'] + 0.5:
+            found.append(f'{name}: {row["queries"]:.1f} queries per request, baseline {expected["queries"]:.1f}')
+        # p99 is reported but too noisy over a few hundred requests to compare
+        for key in ('p50_ms', 'p95_ms'):
+            if row[key] > expected[key] * (1 + args.tolerance):
+                found.append(f'{name}: {key} {row[key]:.2f}, baseline {expected[key]:.2f}')
+        if row['throughput'] < expected['throughput'] * (1 - args.tolerance):
+            found.append(f'{name}: {row["throughput"]:.1f} requests/s, baseline {expected["throughput"]:.1f}')
+    return found
+
+# Serve the app from a socket shared with the other worker processes
+def serve(fd):
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', 0, app, fd=fd).serve_forever()
+
+# Start worker processes accepting connections on one listening socket, like a
+# preforking server, returning them and the port they listen on
+def start_server():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    workers = [multiprocessing.Process(target=serve, args=(sock.fileno(),), daemon=True) for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    return workers, sock.getsockname()[1]
+
+def main():
+    dataset = {'users': args.users, 'categories': args.categories, 'products': args.products, 'orders': args.orders}
+    if args.virtual_users > args.users:
+        parser.error('--virtual-users can not be more than --users')
+    print(f'Seeding {args.users} users, {args.categories} categories, {args.products} products and {args.orders} orders...')
+    with app.app_context():
+        upgrade()
+        user_ids = seed(users=args.users, categories=args.categories, products=args.products, orders=args.orders)
+        # Forked server processes must open their own connections
+        db.engine.dispose()
+    categories = list(range(1, args.categories + 1))
+    products = list(range(1, args.products + 1))
+
+    workers = []
+    if args.server:
+        workers, port = start_server()
+        make_client = lambda: HttpClient(f'http://127.0.0.1:{port}')
+    else:
+        make_client = TestClient
+
+    results = Results()
+    mode = f'{args.processes} server processes' if args.server else 'the test client'
+    print(f'Running {args.virtual_users} virtual users with {mode}...')
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.virtual_users) as executor:
+            for future in [executor.submit(virtual_user, user_ids[n], make_client, results, categories, products) for n in range(args.virtual_users)]:
+                future.result()
+    finally:
+        for worker in workers:
+            worker.terminate()
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed)
+    report(summary, elapsed)
+    run = {'dataset': dataset, 'virtual_users': args.virtual_users, 'server': args.server, 'cart_backend': app.config['CART_BACKEND'], 'pages': summary}
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(run, file, indent=2)
+            file.write('\n')
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare with, run with --save-baseline to record one')
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if any(baseline.get(key) != run[key] for key in ('dataset', 'virtual_users', 'server', 'cart_backend')):
+        print('The baseline was recorded with different settings, not comparing')
+        return 0
+    found = regressions(summary, baseline)
+    for problem in found:
+        print(f'REGRESSION {problem}')
+    print('Slower than the baseline' if found else 'Within the baseline')
+    return 1 if found else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,115 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from dotenv import load_dotenv
-import os
+from grocerystore.database import database_config, sqlite_pragmas, RoutingSession
 
-load_dotenv()
+# The extensions are created unbound, so importing the package does no I/O.
+# create_app binds them to each app it makes.
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = "main.login"
+login_manager.login_message_category = "info"
 
-app = Flask(__name__)
+# Read the settings from environment variables, returning them as Flask config
+def load_config(environ, instance_path):
+    # Database URLs, connection pool and SQLite settings, checked before anything else starts
+    config = database_config(environ)
+    config['SECRET_KEY'] = environ.get('SECRET_KEY')
+    # Password hashing cost and the size of the worker pool that runs it
+    config['BCRYPT_LOG_ROUNDS'] = int(environ.get('BCRYPT_LOG_ROUNDS', 12))
+    config['PASSWORD_HASH_WORKERS'] = int(environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+    config['PASSWORD_HASH_QUEUE'] = int(environ.get('PASSWORD_HASH_QUEUE', 16))
+    # Number of logged in users cached per process, and for how many seconds
+    config['USER_CACHE_SIZE'] = int(environ.get('USER_CACHE_SIZE', 10000))
+    config['USER_CACHE_TTL'] = int(environ.get('USER_CACHE_TTL', 60))
+    # What deleting products does to their orders: 'soft' keeps them hidden, 'cascade' removes them
+    config['DELETE_POLICY'] = environ.get('DELETE_POLICY', 'soft')
+    # Cache for rendered catalog pages: 'memory', 'file' (shared by worker processes) or 'none'
+    config['RENDER_CACHE'] = environ.get('RENDER_CACHE', 'memory')
+    config['RENDER_CACHE_SIZE'] = int(environ.get('RENDER_CACHE_SIZE', 1000))
+    config['RENDER_CACHE_DIR'] = environ.get('RENDER_CACHE_DIR', os.path.join(instance_path, 'render_cache'))
+    # Where carts are kept: 'database', 'memory' (one worker process only) or 'session' (the signed cookie).
+    # Memory carts not changed for CART_TTL seconds are dropped.
+    config['CART_BACKEND'] = environ.get('CART_BACKEND', 'database')
+    config['CART_SIZE'] = int(environ.get('CART_SIZE', 10000))
+    config['CART_TTL'] = int(environ.get('CART_TTL', 24 * 3600))
+    # Products shown in carts are cached per process, for this many products and seconds
+    config['PRODUCT_SNAPSHOT_SIZE'] = int(environ.get('PRODUCT_SNAPSHOT_SIZE', 10000))
+    config['PRODUCT_SNAPSHOT_TTL'] = int(environ.get('PRODUCT_SNAPSHOT_TTL', 30))
+    # Seconds stock stays reserved for a cart line after the cart last changed, 0 to not reserve stock,
+    # and how often each worker process gives back the stock of expired reservations (0 to only use 'flask inventory expire')
+    config['RESERVATION_TTL'] = int(environ.get('RESERVATION_TTL', 15 * 60))
+    config['RESERVATION_SWEEP_INTERVAL'] = int(environ.get('RESERVATION_SWEEP_INTERVAL', 60))
+    # When orders are added to the sales rollups: 'checkout' (in the order's transaction) or 'batch' ('flask sales rollup')
+    config['SALES_ROLLUPS'] = environ.get('SALES_ROLLUPS', 'checkout')
+    # Orders older than this many days are moved to segment files by 'flask orders archive',
+    # kept in ORDER_ARCHIVE_DIR, with this many segments kept decoded per process
+    config['ORDER_ARCHIVE_DAYS'] = int(environ.get('ORDER_ARCHIVE_DAYS', 365))
+    config['ORDER_ARCHIVE_DIR'] = environ.get('ORDER_ARCHIVE_DIR', os.path.join(instance_path, 'order_archive'))
+    config['ORDER_ARCHIVE_CACHE'] = int(environ.get('ORDER_ARCHIVE_CACHE', 8))
+    # Add a Server-Timing header with SQL, template and password hashing times to
+    # responses, except streamed pages, whose headers are sent before they render
+    config['SERVER_TIMING'] = environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes', 'on')
+    # Most SQL queries one request should run, 0 for no limit, and whether going over it is logged or raised (for development)
+    config['QUERY_BUDGET'] = int(environ.get('QUERY_BUDGET', 0))
+    config['QUERY_BUDGET_ACTION'] = environ.get('QUERY_BUDGET_ACTION', 'log')
+    # Where rate limit buckets are kept: 'memory' (per process), 'shared' (a file mapped by all worker processes) or 'none',
+    # and the most clients tracked. Limits are 'requests/seconds' per client, or 0 for none:
+    # sign ins and registrations per address, failed sign ins per email, and cart changes per user.
+    config['RATE_LIMITS'] = environ.get('RATE_LIMITS', 'memory')
+    config['RATE_LIMIT_FILE'] = environ.get('RATE_LIMIT_FILE', os.path.join(instance_path, 'rate_limits'))
+    config['RATE_LIMIT_SLOTS'] = int(environ.get('RATE_LIMIT_SLOTS', 65536))
+    config['AUTH_RATE_LIMIT'] = environ.get('AUTH_RATE_LIMIT', '20/60')
+    config['ACCOUNT_RATE_LIMIT'] = environ.get('ACCOUNT_RATE_LIMIT', '10/60')
+    config['CART_RATE_LIMIT'] = environ.get('CART_RATE_LIMIT', '60/60')
+    # Most sign ins and cart changes running at once in each worker process, 0 for no limit
+    config['AUTH_CONCURRENCY'] = int(environ.get('AUTH_CONCURRENCY', 32))
+    config['CART_CONCURRENCY'] = int(environ.get('CART_CONCURRENCY', 32))
+    # Compress text responses of at least COMPRESS_MIN_SIZE bytes with gzip, or brotli when it is installed
+    config['COMPRESS'] = environ.get('COMPRESS', 'true').lower() in ('1', 'true', 'yes', 'on')
+    config['COMPRESS_MIN_SIZE'] = int(environ.get('COMPRESS_MIN_SIZE', 500))
+    config['GZIP_LEVEL'] = int(environ.get('GZIP_LEVEL', 6))
+    config['BROTLI_QUALITY'] = int(environ.get('BROTLI_QUALITY', 4))
+    # Where compiled templates are kept for the worker processes, empty to compile them in every process
+    config['TEMPLATE_CACHE_DIR'] = environ.get('TEMPLATE_CACHE_DIR', os.path.join(instance_path, 'template_cache'))
+    # Async serving mode (asgi.py): the database URL of the asyncio engine, by default the primary
+    # database with its async driver, the connections it keeps, and the threads that run the other views
+    config['ASYNC_DATABASE_URI'] = environ.get('ASYNC_DATABASE_URI')
+    config['ASYNC_POOL_SIZE'] = int(environ.get('ASYNC_POOL_SIZE', 10))
+    config['ASYNC_THREADS'] = int(environ.get('ASYNC_THREADS', 32))
+    # Token that /metrics requests must send as a bearer token. Without one,
+    # /metrics is only shown to signed in admins.
+    config['METRICS_TOKEN'] = environ.get('METRICS_TOKEN')
+    # Compact API responses, without indentation or spaces
+    config['RESTFUL_JSON'] = {'separators': (',', ':')}
+    return config
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+# Create an app. The settings are read from the environment and a .env file,
+# and config can override any of them with values written the same way, like
+# {'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'CART_BACKEND': 'memory'}.
+# Other keys of config, like TESTING, are set on the app as they are.
+def create_app(config=None):
+    config = config or {}
+    load_dotenv()
+    app = Flask(__name__)
+    settings = load_config(dict(os.environ, **{key: str(value) for key, value in config.items()}), app.instance_path)
+    app.config.update(settings)
+    app.config.update({key: value for key, value in config.items() if key not in settings})
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-login_manager.login_view = "login"
-login_manager.login_message_category = "info"
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+    with app.app_context():
+        sqlite_pragmas(db.engines.values(), app.config['SQLITE_PRAGMAS'])
 
-from grocerystore import routes
\ No newline at end of file
+    # Routes and the modules with per app state are only imported here
+    from grocerystore import delivery, metrics, render_cache, user_cache, carts, passwords, limits, inventory, archive, routes, api, commands
+    for module in (delivery, metrics, render_cache, user_cache, carts, passwords, limits, inventory, archive, commands):
+        module.init_app(app)
+    app.register_blueprint(routes.main)
+    app.register_blueprint(api.blueprint)
+    return app
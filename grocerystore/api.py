@@ -0,0 +1,221 @@
+from functools import wraps
+from flask import Blueprint, request
+from flask_login import current_user, login_user, logout_user
+from flask_restful import Api, Resource, abort
+from grocerystore import carts, checkout
+from grocerystore.models import User, Product, Category
+from grocerystore.catalog import split_page
+from grocerystore.history import get_order_history, get_grand_total
+from grocerystore.search import search_products, parse_price_range
+from grocerystore.passwords import check_password
+from grocerystore.database import replica_reads
+from grocerystore.limits import rate_limited, failed
+
+# JSON API for the catalog, cart and orders, for clients that don't need HTML
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+api = Api(blueprint)
+
+# Default and largest number of items in one page of a list
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Decorator for resources that need a logged in user
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401, message='Login required.')
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Get the page size from the request
+def page_size():
+    return min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+# Keep only the fields the client asked for with ?fields=a,b,c
+def select_fields(item):
+    fields = request.args.get('fields')
+    if not fields:
+        return item
+    wanted = set(fields.split(','))
+    return {key: value for key, value in item.items() if key in wanted}
+
+def product_json(product):
+    return select_fields({
+        'id': product.id,
+        'name': product.name,
+        'price': product.price,
+        'category_id': product.category_id,
+        'quantity': product.quantity,
+        'manufacture_date': product.manufacture_date.isoformat(),
+    })
+
+def category_json(category):
+    return select_fields({'id': category.id, 'name': category.name})
+
+def cart_json(cart, total):
+    return {
+        'items': [{'product_id': item.product_id, 'name': item.product.name, 'price': item.product.price, 'quantity': item.quantity} for item in cart],
+        'total': total,
+    }
+
+def order_json(order):
+    return {
+        'id': order.id,
+        'total': order.total,
+        'datetime_ordered': order.datetime_ordered.isoformat(),
+        'lines': [{'product_id': line.product_id, 'name': line.product.name, 'price': line.price, 'quantity': line.quantity} for line in order.lines],
+    }
+
+# Get the JSON object sent as the request body, or an empty one when there is none
+def json_body():
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        abort(400, message='The body must be a JSON object.')
+    return body
+
+# Read a list of {product_id, quantity} items from the request body as a dict
+def cart_changes():
+    body = json_body()
+    items = body.get('items', [body] if 'product_id' in body else [])
+    if not isinstance(items, list):
+        abort(400, message='items must be a list.')
+    changes = {}
+    for item in items:
+        try:
+            product_id, quantity = int(item['product_id']), int(item['quantity'])
+        except (KeyError, TypeError, ValueError):
+            abort(400, message='Each item needs an integer product_id and quantity.')
+        if quantity < 1:
+            abort(400, message='Quantities must be at least 1.')
+        changes[product_id] = quantity
+    if not changes:
+        abort(400, message='No items given.')
+    return changes
+
+# Apply cart changes and return the new cart, or the reason they failed
+def change_cart(add):
+    try:
+        carts.change_cart(current_user.id, cart_changes(), add=add)
+    except carts.UnknownProduct as error:
+        abort(404, message='Unknown products.', product_ids=error.args[0])
+    except checkout.OutOfStock as error:
+        abort(409, message='Not enough stock.', product_id=error.args[0].id)
+    return cart_json(*carts.get_cart(current_user.id))
+
+# Log in and out, using the same session cookie as the website
+class Session(Resource):
+    method_decorators = {'post': [rate_limited('auth')]}
+
+    def post(self):
+        body = json_body()
+        email, password = body.get('email'), body.get('password') or ''
+        if not isinstance(email, str) or not isinstance(password, str):
+            abort(400, message='email and password must be strings.')
+        user = User.query.filter_by(email=email).first()
+        if not user or not check_password(user, password):
+            failed('auth')
+            abort(401, message='Incorrect email or password.')
+        login_user(user, remember=bool(body.get('remember')))
+        return {'id': user.id, 'name': user.name, 'is_admin': user.is_admin}
+
+    def delete(self):
+        logout_user()
+        return '', 204
+
+class CategoryList(Resource):
+    method_decorators = [replica_reads, api_login_required]
+
+    def get(self):
+        query = Category.query
+        after = request.args.get('after', type=int)
+        if after:
+            query = query.filter(Category.id > after)
+        categories, next_after = split_page(query.order_by(Category.id).limit(page_size() + 1).all(), page_size())
+        return {'items': [category_json(category) for category in categories], 'next': next_after}
+
+# List products by category with cursor pagination, or search them by name and price
+class ProductList(Resource):
+    method_decorators = [replica_reads, api_login_required]
+
+    def get(self):
+        name = request.args.get('q')
+        price = request.args.get('price')
+        if name or price:
+            try:
+                min_price, max_price = parse_price_range(price) if price else (None, None)
+            except ValueError:
+                abort(400, message='Not a valid price.')
+            page = request.args.get('page', 1, type=int)
+            results = search_products(name=name, min_price=min_price, max_price=max_price, page=page, per_page=page_size())
+            return {'items': [product_json(product) for product in results.products], 'next_page': page + 1 if results.has_next else None}
+
+        query = Product.query
+        category = request.args.get('category', type=int)
+        if category:
+            query = query.filter(Product.category_id == category)
+        after = request.args.get('after', type=int)
+        if after:
+            query = query.filter(Product.id > after)
+        products, next_after = split_page(query.order_by(Product.id).limit(page_size() + 1).all(), page_size())
+        return {'items': [product_json(product) for product in products], 'next': next_after}
+
+class ProductDetail(Resource):
+    method_decorators = [replica_reads, api_login_required]
+
+    def get(self, product_id):
+        product = Product.query.get_or_404(product_id)
+        return dict(product_json(product), **select_fields({'category': product.category.name}))
+
+# The current user's cart. POST adds items, PUT sets their quantities and
+# DELETE removes the given product_ids, or everything.
+class CartResource(Resource):
+    method_decorators = [rate_limited('cart'), api_login_required]
+
+    def get(self):
+        return cart_json(*carts.get_cart(current_user.id))
+
+    def post(self):
+        return change_cart(add=True)
+
+    def put(self):
+        return change_cart(add=False)
+
+    def delete(self):
+        product_ids = json_body().get('product_ids')
+        if product_ids is not None and not (isinstance(product_ids, list) and all(type(product_id) is int for product_id in product_ids)):
+            abort(400, message='product_ids must be a list of integer ids.')
+        carts.remove_from_cart(current_user.id, product_ids)
+        return cart_json(*carts.get_cart(current_user.id))
+
+class CartItem(Resource):
+    method_decorators = [rate_limited('cart'), api_login_required]
+
+    def delete(self, product_id):
+        carts.remove_from_cart(current_user.id, [product_id])
+        return cart_json(*carts.get_cart(current_user.id))
+
+# Order history, and checkout of the cart with POST
+class OrderList(Resource):
+    method_decorators = [api_login_required]
+
+    def get(self):
+        orders, next_before = get_order_history(current_user.id, before=request.args.get('before', type=int), limit=page_size())
+        return {'items': [order_json(order) for order in orders], 'next': next_before, 'grand_total': get_grand_total(current_user.id)}
+
+    def post(self):
+        try:
+            order = checkout.place_order(current_user.id)
+        except checkout.EmptyCart:
+            abort(400, message='Cart is empty.')
+        except checkout.OutOfStock:
+            abort(409, message='Not enough stock.')
+        return order_json(order), 201
+
+api.add_resource(Session, '/session')
+api.add_resource(CategoryList, '/categories')
+api.add_resource(ProductList, '/products')
+api.add_resource(ProductDetail, '/products/<int:product_id>')
+api.add_resource(CartResource, '/cart')
+api.add_resource(CartItem, '/cart/<int:product_id>')
+api.add_resource(OrderList, '/orders')
@@ -0,0 +1,188 @@
+import gzip
+import json
+import os
+import tempfile
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import current_app
+from sqlalchemy import select, insert, delete, func
+from werkzeug.local import LocalProxy
+from grocerystore import db
+from grocerystore.models import Product, Order, OrderHeader, OrderSegment, ArchivedOrders
+
+# Orders older than ORDER_ARCHIVE_DAYS are moved out of the order tables by
+# 'flask orders archive', so the tables and their indexes stay small. Each run
+# writes segment files of up to SEGMENT_ORDERS orders: gzipped JSON with one
+# list per column, sorted by user and newest order first. Each user's slice of
+# a file is recorded in ArchivedOrders in the transaction that deletes the
+# orders, and the file is only read when a user pages past their live orders.
+
+# Orders written to one segment file
+SEGMENT_ORDERS = 10000
+
+# Archived orders look like live ones to the templates and the API
+ArchivedOrder = namedtuple('ArchivedOrder', ['id', 'total', 'datetime_ordered', 'lines'])
+ArchivedLine = namedtuple('ArchivedLine', ['product_id', 'product', 'quantity', 'price'])
+# Products are archived by name, as they were when their orders were archived
+ArchivedProduct = namedtuple('ArchivedProduct', ['id', 'name'])
+
+# Segment files in a directory, keeping the most recently read ones decoded in memory
+class SegmentStore:
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.segments = OrderedDict()
+        self.lock = Lock()
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    # Write a file atomically and make sure it is on disk before the orders in it are deleted
+    def write(self, filename, columns):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as file:
+                file.write(json.dumps(columns, separators=(',', ':')).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(temp, self.path(filename))
+
+    def remove(self, filename):
+        try:
+            os.remove(self.path(filename))
+        except OSError:
+            pass
+
+    def read(self, filename):
+        with self.lock:
+            columns = self.segments.get(filename)
+            if columns is not None:
+                self.segments.move_to_end(filename)
+                return columns
+        with gzip.open(self.path(filename)) as file:
+            columns = json.load(file)
+        with self.lock:
+            self.segments[filename] = columns
+            while len(self.segments) > self.size:
+                self.segments.popitem(last=False)
+        return columns
+
+# The segment store of the current app
+segment_store = LocalProxy(lambda: current_app.extensions['order_archive'])
+
+def init_app(app):
+    app.extensions['order_archive'] = SegmentStore(app.config['ORDER_ARCHIVE_DIR'], app.config['ORDER_ARCHIVE_CACHE'])
+
+# Move orders placed more than days ago into segment files, returning how many
+# were moved. Orders go oldest first, up to the first one that is too new or
+# isn't in the sales rollups yet, so every archived order is older than every
+# live one and order history can page from one to the other by id. The newest
+# order always stays, so new order ids keep growing past the archived ones.
+def archive_orders(days=None, segment_size=SEGMENT_ORDERS):
+    days = current_app.config['ORDER_ARCHIVE_DAYS'] if days is None else days
+    horizon = datetime.utcnow() - timedelta(days=days)
+    newest = db.session.scalar(select(func.max(OrderHeader.id)))
+    if newest is None:
+        return 0
+    kept = db.session.scalar(select(func.min(OrderHeader.id)).where((OrderHeader.datetime_ordered >= horizon) | (OrderHeader.rolled_up == False)))
+    cutoff = min(kept or newest, newest)
+    count = 0
+    while True:
+        headers = db.session.execute(
+            select(OrderHeader.id, OrderHeader.user_id, OrderHeader.total, OrderHeader.datetime_ordered)
+            .where(OrderHeader.id < cutoff)
+            .order_by(OrderHeader.id)
+            .limit(segment_size)
+        ).all()
+        if not headers:
+            return count
+        first_id, last_id = headers[0].id, headers[-1].id
+        lines = db.session.execute(
+            select(Order.id, Order.user_id, Order.header_id, Order.product_id, Product.name, Order.quantity, Order.price)
+            .join(Product, Product.id == Order.product_id)
+            .where(Order.header_id.between(first_id, last_id))
+            .execution_options(include_deleted=True)
+        ).all()
+        headers.sort(key=lambda header: (header.user_id, -header.id))
+        lines.sort(key=lambda line: (line.user_id, -line.header_id, line.id))
+
+        # Where each user's rows start in the columns, and how many there are
+        users = {}
+        for n, header in enumerate(headers):
+            entry = users.setdefault(header.user_id, {'user_id': header.user_id, 'orders': 0, 'total': 0.0, 'header_start': n, 'line_start': 0, 'line_count': 0})
+            entry['orders'] += 1
+            entry['total'] += header.total
+            entry['oldest_id'] = header.id
+        for n, line in enumerate(lines):
+            entry = users[line.user_id]
+            if not entry['line_count']:
+                entry['line_start'] = n
+            entry['line_count'] += 1
+        columns = {
+            'headers': {
+                'id': [header.id for header in headers],
+                'user_id': [header.user_id for header in headers],
+                'total': [header.total for header in headers],
+                'datetime_ordered': [header.datetime_ordered.isoformat() for header in headers],
+            },
+            'lines': {
+                'header_id': [line.header_id for line in lines],
+                'product_id': [line.product_id for line in lines],
+                'name': [line.name for line in lines],
+                'quantity': [line.quantity for line in lines],
+                'price': [line.price for line in lines],
+            },
+        }
+
+        filename = f'orders-{first_id}-{last_id}.json.gz'
+        segment_store.write(filename, columns)
+        try:
+            segment = OrderSegment(filename=filename, orders=len(headers), first_id=first_id, last_id=last_id)
+            db.session.add(segment)
+            db.session.flush()
+            db.session.execute(insert(ArchivedOrders), [dict(entry, segment_id=segment.id) for entry in users.values()])
+            db.session.execute(delete(Order).where(Order.header_id.between(first_id, last_id)), execution_options={'synchronize_session': False})
+            db.session.execute(delete(OrderHeader).where(OrderHeader.id.between(first_id, last_id)), execution_options={'synchronize_session': False})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            segment_store.remove(filename)
+            raise
+        count += len(headers)
+
+# A user's orders in a segment, newest first, older than the order id before
+def segment_orders(columns, entry, before=None):
+    headers, lines = columns['headers'], columns['lines']
+    order_lines = defaultdict(list)
+    for n in range(entry.line_start, entry.line_start + entry.line_count):
+        order_lines[lines['header_id'][n]].append(
+            ArchivedLine(lines['product_id'][n], ArchivedProduct(lines['product_id'][n], lines['name'][n]), lines['quantity'][n], lines['price'][n])
+        )
+    return [
+        ArchivedOrder(headers['id'][n], headers['total'][n], datetime.fromisoformat(headers['datetime_ordered'][n]), order_lines[headers['id'][n]])
+        for n in range(entry.header_start, entry.header_start + entry.orders)
+        if before is None or headers['id'][n] < before
+    ]
+
+# Get up to limit of a user's archived orders, newest first, older than the
+# order id before. Segments are read newest first and only as far as needed.
+def archived_orders(user_id, before=None, limit=10):
+    query = select(ArchivedOrders, OrderSegment.filename).join(ArchivedOrders.segment).where(ArchivedOrders.user_id == user_id)
+    if before:
+        query = query.where(ArchivedOrders.oldest_id < before)
+    orders = []
+    for entry, filename in db.session.execute(query.order_by(ArchivedOrders.oldest_id.desc())).all():
+        orders += segment_orders(segment_store.read(filename), entry, before)
+        if len(orders) >= limit:
+            break
+    return orders[:limit]
+
+# Total of a user's archived orders, as a subquery for adding to the live total
+def archived_total(user_id):
+    return select(func.coalesce(func.sum(ArchivedOrders.total), 0)).where(ArchivedOrders.user_id == user_id).scalar_subquery()
+
+# Whether any orders were archived
+def has_archive():
+    return db.session.scalar(select(func.count()).select_from(OrderSegment)) > 0
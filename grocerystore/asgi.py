@@ -0,0 +1,227 @@
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from grocerystore import create_app, db
+from grocerystore.database import ConfigError, sqlite_pragmas
+from grocerystore.metrics import watch_engine
+from grocerystore.limits import Overloaded, stats, stats_lock
+
+# Async serving mode, for ASGI servers like uvicorn (see asgi.py next to app.py).
+# The read-heavy pages and API resources run as async views: the store's own
+# view functions, run by SQLAlchemy's asyncio support with db.session bound to
+# an AsyncSession, so a request waiting on the database only holds a small
+# task on the event loop instead of a thread. Everything else goes to the
+# Flask app on a pool of ASYNC_THREADS threads, as under a WSGI server. The
+# async views read from the primary database, never the replica.
+# Password hashing and response compression run in thread pools either way,
+# and templates render on the event loop. Middleware wrapped around
+# app.wsgi_app, like ProxyFix, only sees the requests that go to the threads.
+
+# Endpoints served by async views, for GET and HEAD. The other views write,
+# hash passwords or are rarely used, and run on the threads.
+ASYNC_ENDPOINTS = {
+    'main.home', 'main.view_category', 'main.view_product', 'main.view_cart', 'main.orders',
+    'api.categorylist', 'api.productlist', 'api.productdetail', 'api.cartresource', 'api.orderlist',
+}
+
+# Async drivers of the databases the store runs on
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'mysql': 'aiomysql'}
+
+# The database URL of the asyncio engine: ASYNC_DATABASE_URI, or the primary
+# database with the async driver of its kind
+def async_database_url(config):
+    if config['ASYNC_DATABASE_URI']:
+        return make_url(config['ASYNC_DATABASE_URI'])
+    url = config['SQLALCHEMY_DATABASE_URI']
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ConfigError(f'No async driver known for {backend} databases, set ASYNC_DATABASE_URI')
+    if backend == 'sqlite' and url.database in (None, '', ':memory:'):
+        raise ConfigError('The async mode needs a database file, an in-memory SQLite database is not shared between engines')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+# Create the asyncio engine, with a pool of ASYNC_POOL_SIZE connections.
+# aiosqlite would otherwise open a new connection for every session.
+def create_engine(config):
+    url = async_database_url(config)
+    options = dict(config['SQLALCHEMY_ENGINE_OPTIONS'], pool_size=config['ASYNC_POOL_SIZE'])
+    if url.get_backend_name() == 'sqlite':
+        options.update(poolclass=AsyncAdaptedQueuePool, max_overflow=0)
+    engine = create_async_engine(url, **options)
+    sqlite_pragmas([engine.sync_engine], config['SQLITE_PRAGMAS'])
+    watch_engine(engine.sync_engine)
+    return engine
+
+# Build the environ a WSGI server would give the app for an ASGI request
+def wsgi_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name in ('content-type', 'content-length'):
+            key = name.upper().replace('-', '_')
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        # Repeated headers are joined, cookies the way browsers send them
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+# Read the whole body of an ASGI request
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+# The ASGI app of the store
+class AsyncStore:
+    def __init__(self, app):
+        self.app = app
+        self.engine = create_engine(app.config)
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.threads = ThreadPoolExecutor(app.config['ASYNC_THREADS'], thread_name_prefix='grocerystore')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI connection type: {scope["type"]}')
+        body = await read_body(receive)
+        if body is None:
+            return
+        environ = wsgi_environ(scope, body)
+        if self.is_async(environ):
+            chunks, status, headers = (await self.dispatch(environ)).get_wsgi_response(environ)
+            await self.send(send, status, headers, chunks)
+        else:
+            status, headers, chunks = await self.in_thread(self.call_wsgi, environ)
+            await self.send(send, status, headers, chunks, threaded=True)
+
+    # Whether a request goes to an async view
+    def is_async(self, environ):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return False
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ, server_name=self.app.config['SERVER_NAME']).match()
+        except HTTPException:
+            return False
+        return endpoint in ASYNC_ENDPOINTS
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                self.threads.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Run a function on the threads, in the current context so it sees the request
+    async def in_thread(self, f, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.threads, contextvars.copy_context().run, f, *args)
+
+    # Handle a request with its async view, the way Flask handles a request with its view
+    async def dispatch(self, environ):
+        app = self.app
+        context = app.request_context(environ)
+        context.push()
+        error = None
+        try:
+            async with self.sessions() as session:
+                # db.session is scoped to the app context, so for this request it is the AsyncSession's own Session
+                db.session.registry.set(session.sync_session)
+                rv = await session.run_sync(self.view)
+            # The response is compressed here, so it runs on a thread
+            return await self.in_thread(app.finalize_request, rv)
+        except Exception as e:
+            error = e
+            return app.handle_exception(e)
+        finally:
+            context.pop(error)
+
+    # Run the view of the request. Queries it makes wait on the event loop.
+    def view(self, session):
+        try:
+            rv = self.app.preprocess_request()
+            if rv is None:
+                rv = self.app.dispatch_request()
+            return rv
+        except PoolTimeout:
+            # No connection came free in time, so the request is refused like other overloads
+            with stats_lock:
+                stats['overloaded'] += 1
+            return self.app.handle_user_exception(Overloaded(retry_after=1))
+        except Exception as e:
+            return self.app.handle_user_exception(e)
+
+    # Run a request through the Flask app like a WSGI server does
+    def call_wsgi(self, environ):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        chunks = self.app(environ, start_response)
+        return started[0], started[1], chunks
+
+    # Send a response. The bodies of the Flask app's own views may be streamed
+    # from the database, so their chunks are read on the threads.
+    async def send(self, send, status, headers, chunks, threaded=False):
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        iterator = iter(chunks)
+        try:
+            while True:
+                chunk = await self.in_thread(next, iterator, None) if threaded else next(iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(chunks, 'close'):
+                if threaded:
+                    await self.in_thread(chunks.close)
+                else:
+                    chunks.close()
+        await send({'type': 'http.response.body', 'body': b''})
+
+# Create the ASGI app, with a Flask app made by create_app(config)
+def create_asgi_app(config=None):
+    return AsyncStore(create_app(config))
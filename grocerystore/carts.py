@@ -0,0 +1,222 @@
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from flask import session, current_app
+from sqlalchemy import select, update, insert, delete, bindparam
+from werkzeug.local import LocalProxy
+from grocerystore import db
+from grocerystore.models import Product, Cart
+from grocerystore.render_cache import render_cache
+from grocerystore.inventory import OutOfStock, reservations_enabled, reserve, release, unexpired_reservations
+
+# Raised when a cart change refers to a product that doesn't exist
+class UnknownProduct(Exception):
+    pass
+
+# One line of a cart, with the product it is for
+CartLine = namedtuple('CartLine', ['product_id', 'product', 'quantity'])
+# The product fields a cart needs, copied so they can be shared between requests
+ProductSnapshot = namedtuple('ProductSnapshot', ['id', 'name', 'price', 'quantity'])
+
+# Carts are kept by a cart store, chosen with CART_BACKEND. Every store maps a
+# user's product ids to quantities with the same three methods:
+#   lines(user_id)                    the cart as {product_id: quantity}, oldest line first
+#   save(user_id, quantities, lines)  set the quantities of some products, given the current lines
+#   remove(user_id, product_ids)      remove some products, or every product when None
+# Stores outside the database never write to it, apart from reservations (see
+# inventory.py), and without reservations carts are only checked against the
+# product table at checkout.
+
+# Carts as rows of the cart table, saved in the caller's transaction
+class DatabaseCartStore:
+    in_database = True
+
+    def lines(self, user_id):
+        return dict(db.session.execute(select(Cart.product_id, Cart.quantity).where(Cart.user_id == user_id).order_by(Cart.id)).all())
+
+    def save(self, user_id, quantities, lines):
+        updates = [{'product': product_id, 'amount': quantity} for product_id, quantity in quantities.items() if product_id in lines]
+        inserts = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity} for product_id, quantity in quantities.items() if product_id not in lines]
+        if updates:
+            db.session.execute(
+                update(Cart.__table__)
+                .where(Cart.__table__.c.user_id == user_id, Cart.__table__.c.product_id == bindparam('product'))
+                .values(quantity=bindparam('amount')),
+                updates,
+            )
+        if inserts:
+            db.session.execute(insert(Cart), inserts)
+
+    def remove(self, user_id, product_ids=None):
+        statement = delete(Cart).where(Cart.user_id == user_id)
+        if product_ids is not None:
+            statement = statement.where(Cart.product_id.in_(product_ids))
+        db.session.execute(statement)
+
+# Carts kept in the memory of one process, so only for a single worker process.
+# Carts not changed for CART_TTL seconds are dropped, and the least recently
+# used carts go first when there are more than CART_SIZE.
+class MemoryCartStore:
+    in_database = False
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.carts = OrderedDict()
+        self.lock = Lock()
+
+    def lines(self, user_id):
+        with self.lock:
+            entry = self.carts.get(user_id)
+            if entry is None:
+                return {}
+            lines, expires = entry
+            if expires < time.monotonic():
+                del self.carts[user_id]
+                return {}
+            self.carts.move_to_end(user_id)
+            return dict(lines)
+
+    def put(self, user_id, lines):
+        if not lines:
+            self.carts.pop(user_id, None)
+            return
+        self.carts[user_id] = (lines, time.monotonic() + self.ttl)
+        self.carts.move_to_end(user_id)
+        while len(self.carts) > self.size:
+            self.carts.popitem(last=False)
+
+    def save(self, user_id, quantities, lines):
+        with self.lock:
+            self.put(user_id, {**lines, **quantities})
+
+    def remove(self, user_id, product_ids=None):
+        with self.lock:
+            lines = self.carts.get(user_id, ({}, 0))[0]
+            self.put(user_id, {} if product_ids is None else {product_id: quantity for product_id, quantity in lines.items() if product_id not in product_ids})
+
+# Carts kept in the signed session cookie, so they work with any number of
+# worker processes and go away with the session
+class SessionCartStore:
+    in_database = False
+
+    def lines(self, user_id):
+        cart = session.get('cart')
+        # A cart left by another user of the same browser isn't shown
+        if not cart or cart['user_id'] != user_id:
+            return {}
+        return {product_id: quantity for product_id, quantity in cart['lines']}
+
+    def put(self, user_id, lines):
+        session['cart'] = {'user_id': user_id, 'lines': [[product_id, quantity] for product_id, quantity in lines.items()]}
+
+    def save(self, user_id, quantities, lines):
+        self.put(user_id, {**lines, **quantities})
+
+    def remove(self, user_id, product_ids=None):
+        lines = self.lines(user_id)
+        self.put(user_id, {} if product_ids is None else {product_id: quantity for product_id, quantity in lines.items() if product_id not in product_ids})
+
+# Products as carts show them, cached for PRODUCT_SNAPSHOT_TTL seconds, keeping
+# the PRODUCT_SNAPSHOT_SIZE most recently used. A snapshot is also dropped as soon
+# as an admin changes its product, using the versions of the render cache, so only
+# the stock shown can be out of date.
+class ProductSnapshots:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.snapshots = OrderedDict()
+        self.lock = Lock()
+
+    def versions(self, product_id):
+        return (render_cache.version('products'), render_cache.version(f'product:{product_id}'))
+
+    # Get snapshots of products, loading the ones not cached with one query.
+    # Products that don't exist (or are deleted) are left out.
+    def get(self, product_ids):
+        now = time.monotonic()
+        found, missing = {}, []
+        for product_id in product_ids:
+            entry = self.snapshots.get(product_id)
+            if entry and entry[1] > now and entry[2] == self.versions(product_id):
+                found[product_id] = entry[0]
+                with self.lock:
+                    if product_id in self.snapshots:
+                        self.snapshots.move_to_end(product_id)
+            else:
+                missing.append(product_id)
+        if missing:
+            rows = db.session.execute(select(Product.id, Product.name, Product.price, Product.quantity).where(Product.id.in_(missing))).all()
+            with self.lock:
+                for row in rows:
+                    found[row.id] = ProductSnapshot(*row)
+                    self.snapshots[row.id] = (found[row.id], now + self.ttl, self.versions(row.id))
+                    self.snapshots.move_to_end(row.id)
+                while len(self.snapshots) > self.size:
+                    self.snapshots.popitem(last=False)
+        return found
+
+# Create the cart store chosen in the config
+def create_store(config):
+    backend = config['CART_BACKEND']
+    if backend == 'database':
+        return DatabaseCartStore()
+    if backend == 'memory':
+        return MemoryCartStore(config['CART_SIZE'], config['CART_TTL'])
+    if backend == 'session':
+        return SessionCartStore()
+    raise ValueError(f'Unknown CART_BACKEND: {backend}')
+
+# The cart store and product snapshots of the current app
+cart_store = LocalProxy(lambda: current_app.extensions['cart_store'])
+product_snapshots = LocalProxy(lambda: current_app.extensions['product_snapshots'])
+
+def init_app(app):
+    app.extensions['cart_store'] = create_store(app.config)
+    app.extensions['product_snapshots'] = ProductSnapshots(app.config['PRODUCT_SNAPSHOT_SIZE'], app.config['PRODUCT_SNAPSHOT_TTL'])
+
+# Get the lines of a user's cart with their products, and the cart total
+def get_cart(user_id):
+    lines = cart_store.lines(user_id)
+    products = product_snapshots.get(lines)
+    # Products deleted since they were added aren't shown
+    cart = [CartLine(product_id, products[product_id], quantity) for product_id, quantity in lines.items() if product_id in products]
+    if reservations_enabled() and cart:
+        # The stock still reserved for this cart can be put in it again. Expired
+        # reservations may already have given their stock back, so they don't count.
+        held = unexpired_reservations(user_id, [item.product_id for item in cart])
+        cart = [item._replace(product=item.product._replace(quantity=item.product.quantity + held.get(item.product_id, 0))) for item in cart]
+    return cart, sum(item.product.price * item.quantity for item in cart)
+
+# Change the quantities of products in a user's cart in one transaction.
+# changes maps product ids to quantities, which are added to the cart when add
+# is true and replace the quantities in the cart otherwise.
+def change_cart(user_id, changes, add=True):
+    products = product_snapshots.get(changes)
+    missing = [product_id for product_id in changes if product_id not in products]
+    if missing:
+        raise UnknownProduct(missing)
+    lines = cart_store.lines(user_id)
+    quantities = {}
+    for product_id, quantity in changes.items():
+        if add:
+            quantity += lines.get(product_id, 0)
+        # Without reservations, check the stock for the whole change before saving anything
+        if not reservations_enabled() and quantity > products[product_id].quantity:
+            raise OutOfStock(products[product_id])
+        quantities[product_id] = quantity
+    try:
+        if reservations_enabled():
+            reserve(user_id, quantities, products)
+        cart_store.save(user_id, quantities, lines)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+# Remove products from a user's cart, or empty it when no products are given
+def remove_from_cart(user_id, product_ids=None):
+    if reservations_enabled():
+        release(user_id, product_ids)
+    cart_store.remove(user_id, product_ids)
+    db.session.commit()
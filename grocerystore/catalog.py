@@ -0,0 +1,56 @@
+from collections import namedtuple, defaultdict
+from sqlalchemy import select, union_all
+from grocerystore.models import Category, Product
+
+# Number of products shown for each category on the home page
+PRODUCTS_PER_CATEGORY = 12
+# Number of categories shown on one home page
+CATEGORIES_PER_PAGE = 10
+
+# A category together with one page of its products
+CatalogSection = namedtuple('CatalogSection', ['category', 'products', 'next_after'])
+# One page of catalog sections and the key to fetch the next page
+CatalogPage = namedtuple('CatalogPage', ['sections', 'next_after'])
+
+# Split a list fetched with one extra row into the page and the key of the next page
+def split_page(items, limit):
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].id
+    return items, None
+
+# Select the ids of one page of products in a category, ordered by id
+def product_ids_page(category_id, after=None, limit=PRODUCTS_PER_CATEGORY):
+    query = select(Product.id).where(Product.category_id == category_id)
+    if after:
+        query = query.where(Product.id > after)
+    # Fetch one extra row so we know if there is a next page
+    return query.order_by(Product.id).limit(limit + 1)
+
+# Get one page of products in a category, starting after the given product id
+def get_category_products(category_id, after=None, limit=PRODUCTS_PER_CATEGORY):
+    products = Product.query.filter(Product.id.in_(product_ids_page(category_id, after, limit))).order_by(Product.id).all()
+    return split_page(products, limit)
+
+# Get one page of categories with the first products of each category.
+# This always runs two queries, whatever the size of the catalog:
+# one for the page of categories and one for a capped page of products per category.
+def get_catalog(categories=None, after=None, limit=PRODUCTS_PER_CATEGORY, per_page=CATEGORIES_PER_PAGE):
+    if categories is None:
+        categories = Category.query
+    if after:
+        categories = categories.filter(Category.id > after)
+    categories, next_after = split_page(categories.order_by(Category.id).limit(per_page + 1).all(), per_page)
+    if not categories:
+        return CatalogPage([], next_after)
+
+    # Each category gets its own LIMIT, so a large category can't crowd out the others
+    ids = union_all(*[product_ids_page(category.id, limit=limit).subquery().select() for category in categories])
+    products = defaultdict(list)
+    for product in Product.query.filter(Product.id.in_(ids)).order_by(Product.id):
+        products[product.category_id].append(product)
+
+    sections = []
+    for category in categories:
+        page, next_product = split_page(products[category.id], limit)
+        sections.append(CatalogSection(category, page, next_product))
+    return CatalogPage(sections, next_after)
@@ -0,0 +1,215 @@
+import csv
+import io
+import json
+from itertools import islice
+from sqlalchemy import select, insert, update, bindparam
+from werkzeug.datastructures import MultiDict
+from grocerystore import db
+from grocerystore.models import Category, Product
+from grocerystore.forms import ProductForm
+from grocerystore.render_cache import invalidate
+from grocerystore.inventory import log_movements
+
+# Columns of an import or export file
+FIELDS = ['id', 'name', 'price', 'category', 'quantity', 'manufacture_date']
+# Number of rows written to the database per transaction
+BATCH_SIZE = 1000
+# Number of row errors kept for the report, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+# Summary of an import
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    # Record an error for a row of the file
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+# Guess the file format from its name
+def file_format(filename):
+    return 'jsonl' if filename.endswith(('.jsonl', '.json')) else 'csv'
+
+# Check if a row has bytes that weren't valid UTF-8. Files are opened with
+# errors='surrogateescape', which keeps such bytes as lone surrogates so the
+# rest of the file can still be read.
+def undecodable(row):
+    for value in row.values():
+        if isinstance(value, str):
+            try:
+                value.encode('utf-8')
+            except UnicodeEncodeError:
+                return True
+    return False
+
+# Read rows from a CSV or JSON Lines file, one (line number, row) at a time.
+# A row that can't be read is given as the reason instead.
+def read_rows(stream, format):
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, 'Not valid UTF-8 text' if undecodable(row) else row
+    else:
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            if not isinstance(row, dict):
+                yield line, 'Not a valid JSON object'
+            else:
+                yield line, 'Not valid UTF-8 text' if undecodable(row) else row
+
+# Validate rows with the same rules as the product form, yielding (line, values or error)
+def validate_rows(rows, categories, create_categories=False):
+    for line, row in rows:
+        if isinstance(row, str):
+            yield line, row
+            continue
+        category_name = str(row.get('category') or '').strip()
+        category_id = categories.get(category_name)
+        if category_id is None and create_categories and category_name:
+            category = Category(name=category_name)
+            db.session.add(category)
+            db.session.commit()
+            category_id = categories[category_name] = category.id
+        if category_id is None:
+            yield line, f'Unknown category: {category_name}'
+            continue
+
+        formdata = MultiDict({field: '' if row.get(field) is None else str(row.get(field)) for field in FIELDS})
+        formdata['category_id'] = str(category_id)
+        form = ProductForm(formdata=formdata, meta={'csrf': False})
+        form.category_id.choices = [(category_id, category_name)]
+        if not form.validate():
+            yield line, '; '.join(f'{field}: {", ".join(errors)}' for field, errors in form.errors.items())
+            continue
+        try:
+            product_id = int(row['id']) if row.get('id') not in (None, '') else None
+        except (TypeError, ValueError):
+            yield line, 'id: Not a valid integer value.'
+            continue
+        yield line, {
+            'id': product_id,
+            'name': form.name.data,
+            'price': form.price.data,
+            'category_id': category_id,
+            'quantity': form.quantity.data,
+            'manufacture_date': form.manufacture_date.data,
+        }
+
+# Split an iterator into lists of at most size items
+def batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+# Insert or update one batch of valid rows in a single transaction.
+# Rows with an id update that product, rows without one update the product
+# with the same name in the same category, or are inserted as new products.
+# A later row for the same product wins, whichever batch it is in.
+def write_batch(rows, result):
+    table = Product.__table__
+    names = {row['name'] for row in rows if row['id'] is None}
+    existing = {}
+    # The stock of the products being updated, so the changes can be logged
+    stock = {}
+    if names:
+        for product_id, category_id, name, quantity in db.session.execute(select(table.c.id, table.c.category_id, table.c.name, table.c.quantity).where(table.c.name.in_(names))):
+            existing.setdefault((category_id, name), product_id)
+            stock[product_id] = quantity
+    known_ids = set()
+    ids = [row['id'] for row in rows if row['id'] is not None]
+    if ids:
+        for product_id, quantity in db.session.execute(select(table.c.id, table.c.quantity).where(table.c.id.in_(ids))):
+            known_ids.add(product_id)
+            stock[product_id] = quantity
+
+    inserts, updates, movements = [], [], []
+    # Rows queued for insert by id and by (category_id, name), so a row repeated
+    # in the batch updates the queued one, as it would in a later batch
+    queued = {}
+    repeats = 0
+    for row in rows:
+        product_id = row['id'] if row['id'] in known_ids else existing.get((row['category_id'], row['name']))
+        if product_id is None:
+            values = {key: value for key, value in row.items() if key != 'id' or value is not None}
+            index = queued.get(row['id'] if row['id'] is not None else (row['category_id'], row['name']))
+            if index is not None:
+                inserts[index].update(values)
+                repeats += 1
+                continue
+            queued.setdefault((row['category_id'], row['name']), len(inserts))
+            if row['id'] is not None:
+                queued[row['id']] = len(inserts)
+            inserts.append(values)
+        else:
+            # Importing a deleted product brings it back
+            updates.append(dict({key: value for key, value in row.items() if key != 'id'}, product_id=product_id, deleted=False))
+            movements.append((product_id, row['quantity'] - stock[product_id], 'import'))
+            stock[product_id] = row['quantity']
+    # Rows with and without an id are inserted apart, as one statement takes its columns from its first row
+    for group in ([row for row in inserts if 'id' in row], [row for row in inserts if 'id' not in row]):
+        if group:
+            new_ids = db.session.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), group).scalars()
+            movements.extend((product_id, row['quantity'], 'import') for product_id, row in zip(new_ids, group))
+    if updates:
+        # The columns to set are taken from the keys of the rows
+        db.session.execute(update(table).where(table.c.id == bindparam('product_id')), updates)
+    log_movements(movements)
+    db.session.commit()
+    result.inserted += len(inserts)
+    result.updated += len(updates) + repeats
+
+# Import products from a CSV or JSON Lines stream in batches, using bounded memory
+def import_products(stream, format='csv', create_categories=False, batch_size=BATCH_SIZE, on_error=None):
+    result = ImportResult()
+    categories = {name: category_id for category_id, name in db.session.execute(select(Category.id, Category.name))}
+    touched = set()
+
+    # Record errors as they come and pass the valid rows on
+    def valid_rows():
+        for line, values in validate_rows(read_rows(stream, format), categories, create_categories):
+            if isinstance(values, str):
+                result.add_error(line, values)
+                if on_error:
+                    on_error(line, values)
+            else:
+                touched.add(values['category_id'])
+                yield values
+
+    try:
+        for batch in batches(valid_rows(), batch_size):
+            write_batch(batch, result)
+    finally:
+        # Products may have moved between categories, so every product page is refreshed
+        invalidate('catalog', 'products', *[f'category:{category_id}' for category_id in touched])
+    return result
+
+# Export all products as CSV or JSON Lines, one chunk of text at a time
+def export_products(format='csv'):
+    query = select(Product.id, Product.name, Product.price, Category.name, Product.quantity, Product.manufacture_date) \
+        .join(Category, Product.category_id == Category.id).order_by(Product.id).execution_options(yield_per=BATCH_SIZE)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == 'csv':
+        writer.writerow(FIELDS)
+    for rows in db.session.execute(query).partitions():
+        for row in rows:
+            values = list(row)
+            values[-1] = values[-1].isoformat()
+            if format == 'csv':
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(FIELDS, values))) + '\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
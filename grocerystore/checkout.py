@@ -0,0 +1,51 @@
+from datetime import datetime
+from sqlalchemy import insert
+from grocerystore import db
+from grocerystore.models import Product, Order, OrderHeader
+from grocerystore.carts import cart_store, remove_from_cart
+from grocerystore.inventory import OutOfStock, take_for_order
+from grocerystore.sales import record_order
+from grocerystore.recommendations import record_checkout, refresh_lists
+
+# Raised when the cart has nothing to order
+class EmptyCart(Exception):
+    pass
+
+# Place an order for everything in the user's cart in a single transaction
+def place_order(user_id):
+    lines = cart_store.lines(user_id)
+    if not lines:
+        raise EmptyCart()
+    # Prices come from the product table, not the snapshots the cart was shown with
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(lines))}
+    gone = [product_id for product_id in lines if product_id not in products]
+    if gone:
+        # Products deleted since they were added can't be ordered any more
+        remove_from_cart(user_id, gone)
+        raise OutOfStock()
+    try:
+        # Uses the stock reserved for the cart, and takes the rest where enough is left
+        take_for_order(user_id, lines)
+        # Save the order total once, so order history never has to add up the lines
+        header = OrderHeader(user_id=user_id, total=sum(products[product_id].price * quantity for product_id, quantity in lines.items()), datetime_ordered=datetime.utcnow())
+        # Added to the sales rollups now, unless they are rolled up in batches
+        record_order(header, lines, products)
+        db.session.add(header)
+        db.session.flush()
+        db.session.execute(insert(Order), [
+            {'header_id': header.id, 'user_id': user_id, 'product_id': product_id, 'quantity': quantity, 'price': products[product_id].price, 'datetime_ordered': header.datetime_ordered}
+            for product_id, quantity in lines.items()
+        ])
+        # Products bought together are counted in the checkout, and their lists updated after it
+        record_checkout(lines)
+        # A cart in the database is emptied in the same transaction
+        if cart_store.in_database:
+            cart_store.remove(user_id, list(lines))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if not cart_store.in_database:
+        cart_store.remove(user_id, list(lines))
+    refresh_lists(lines)
+    return header
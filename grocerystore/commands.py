@@ -0,0 +1,152 @@
+import sys
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from grocerystore import db
+from grocerystore.models import User
+from grocerystore.catalog_io import import_products, export_products, file_format, BATCH_SIZE
+from grocerystore.migrations import upgrade, current_version, HEAD
+from grocerystore.passwords import hash_password
+from grocerystore.inventory import expire_reservations
+from grocerystore.sales import roll_up_orders, backfill
+from grocerystore.delivery import build_assets
+from grocerystore.recommendations import rebuild
+from grocerystore.archive import archive_orders, SEGMENT_ORDERS
+
+# Commands for the database schema
+database = AppGroup('db', help='Manage the database schema.')
+
+# Create the database or bring it up to date
+@database.command('upgrade')
+@click.option('--target', type=int, default=HEAD, show_default=True, help='Schema version to upgrade to.')
+def upgrade_database(target):
+    """Run the migrations the database doesn't have yet."""
+    for name in upgrade(target):
+        click.echo(f'Applied {name}')
+    with db.engine.connect() as connection:
+        click.echo(f'Database schema is at version {current_version(connection)}.')
+
+# Show the schema version of the database
+@database.command('version')
+def database_version():
+    """Show the schema version of the database."""
+    with db.engine.connect() as connection:
+        version = current_version(connection)
+    click.echo(f'Database schema is at version {version}, the latest is {HEAD}.')
+
+# Create the database, or bring it up to date, like 'flask db upgrade'
+@click.command('init-db')
+@with_appcontext
+def init_db():
+    """Create the database tables, or upgrade them to the latest schema."""
+    for name in upgrade():
+        click.echo(f'Applied {name}')
+    click.echo('Database is ready.')
+
+# Create an admin account, or make an existing user an admin
+@click.command('create-admin')
+@click.option('--name', default='Admin', show_default=True)
+@click.option('--username', default='admin', show_default=True)
+@click.option('--email', default='admin@demo.in', show_default=True)
+@click.password_option()
+@with_appcontext
+def create_admin(name, username, email, password):
+    """Create an admin account."""
+    user = User.query.filter((User.username == username) | (User.email == email)).first()
+    if user is None:
+        user = User(name=name, username=username, email=email)
+        db.session.add(user)
+    user.is_admin = True
+    user.password = hash_password(password)
+    db.session.commit()
+    click.echo(f'{user.username} is an admin.')
+
+# Commands for stock
+inventory = AppGroup('inventory', help='Manage stock reservations.')
+
+# Give back the stock of expired reservations, for deployments without the sweeper thread
+@inventory.command('expire')
+def expire():
+    """Give back the stock of expired cart reservations."""
+    click.echo(f'Expired {expire_reservations()} reservations.')
+
+# Commands for the sales rollups
+sales = AppGroup('sales', help='Maintain the sales rollups.')
+
+# Add new orders to the rollups, run periodically when SALES_ROLLUPS is 'batch'
+@sales.command('rollup')
+@click.option('--batch-size', default=1000, show_default=True, help='Orders added per transaction.')
+def rollup(batch_size):
+    """Add orders placed since the last run to the sales rollups."""
+    click.echo(f'Rolled up {roll_up_orders(batch_size)} orders.')
+
+# Rebuild the rollups from scratch, like after upgrading a database with orders
+@sales.command('backfill')
+def backfill_sales():
+    """Rebuild the sales rollups from every order."""
+    backfill()
+    click.echo('Rebuilt the sales rollups.')
+
+# Commands for the recommendations
+recommendations = AppGroup('recommendations', help='Maintain the product recommendations.')
+
+# Count every order again, like after upgrading a database with orders
+@recommendations.command('rebuild')
+def rebuild_recommendations():
+    """Rebuild the products bought together from every order."""
+    rebuild()
+    click.echo('Rebuilt the recommendations.')
+
+# Commands for old orders
+orders = AppGroup('orders', help='Archive old orders.')
+
+# Move old orders out of the order tables, run periodically
+@orders.command('archive')
+@click.option('--days', type=int, help='Archive orders older than this many days, ORDER_ARCHIVE_DAYS by default.')
+@click.option('--segment-size', default=SEGMENT_ORDERS, show_default=True, help='Orders written per segment file.')
+def archive(days, segment_size):
+    """Move old orders into compressed segment files."""
+    click.echo(f'Archived {archive_orders(days, segment_size)} orders.')
+
+# Commands for loading and dumping the product catalog
+catalog = AppGroup('catalog', help='Import and export the product catalog.')
+
+# Import products from a CSV or JSON Lines file
+@catalog.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the file name by default.')
+@click.option('--create-categories', is_flag=True, help='Create categories that do not exist yet.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows written per transaction.')
+def import_catalog(path, format, create_categories, batch_size):
+    """Import products from PATH."""
+    def report(line, message):
+        click.echo(f'{path}:{line}: {message}', err=True)
+    with open(path, encoding='utf-8', errors='surrogateescape', newline='') as stream:
+        result = import_products(stream, format or file_format(path), create_categories, batch_size, on_error=report)
+    click.echo(f'Imported {result.inserted} new and {result.updated} updated products, {result.error_count} rows with errors.')
+    if result.error_count:
+        sys.exit(1)
+
+# Export all products to a CSV or JSON Lines file
+@catalog.command('export')
+@click.argument('path', default='-')
+@click.option('--format', type=click.Choice(['csv', 'jsonl']), help='File format, guessed from the file name by default.')
+def export_catalog(path, format):
+    """Export all products to PATH, or to standard output."""
+    with click.open_file(path, 'w', encoding='utf-8') as stream:
+        for chunk in export_products(format or file_format(path)):
+            stream.write(chunk)
+
+# Commands for the static files
+assets = AppGroup('assets', help='Build the static files.')
+
+# Fingerprint the static files, run when deploying a new version
+@assets.command('build')
+def build():
+    """Copy the static files to names with a hash of their contents."""
+    manifest = build_assets(current_app.static_folder)
+    click.echo(f'Fingerprinted {len(manifest)} static files. Restart the app to link them.')
+
+def init_app(app):
+    for command in (database, init_db, create_admin, inventory, sales, recommendations, orders, catalog, assets):
+        app.cli.add_command(command)
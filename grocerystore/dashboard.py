@@ -0,0 +1,105 @@
+from collections import namedtuple
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.orm import contains_eager
+from grocerystore import db
+from grocerystore.models import User, Product, Category, LowStockEvent
+from grocerystore.search import filter_product_name, search_categories
+
+# Number of rows shown per page of each admin table
+ROWS_PER_PAGE = 20
+# Products with less stock than this are shown by the low stock filter
+LOW_STOCK = 10
+
+# One page of a sortable admin table, with the ids of the rows the next page
+# starts after and the previous page ends before (None when there is no such page)
+TablePage = namedtuple('TablePage', ['name', 'rows', 'sort', 'order', 'after', 'before'])
+
+# Sort and page a query from the table's request arguments (<name>_sort,
+# <name>_order, and <name>_after or <name>_before). Pages are found by keyset
+# on (sort column, id), from the sort value of the row they start after or end
+# before, so a deep page costs as much as the first one. It never counts the
+# rows, it only fetches one more row than fits on the page.
+def table_page(name, query, columns, args, default_order='asc'):
+    sort = args.get(f'{name}_sort')
+    if sort not in columns:
+        sort = 'id'
+    order = args.get(f'{name}_order', default_order)
+    order = 'desc' if order == 'desc' else 'asc'
+    column, key = columns[sort], columns['id']
+    after = args.get(f'{name}_after', type=int)
+    before = args.get(f'{name}_before', type=int) if after is None else None
+    anchor = after if after is not None else before
+    if anchor is not None:
+        value = query.with_entities(column).filter(key == anchor).scalar()
+        if value is None:
+            # The row is gone or no longer matches the filters, so start again
+            after = before = None
+        else:
+            # Sort by id as well, so rows with equal values keep a stable order between pages
+            bound, start = tuple_(column, key), tuple_(value, anchor)
+            query = query.filter(bound < start if (order == 'desc') == (after is not None) else bound > start)
+    # The page before a row is read backwards from it
+    descending = (order == 'desc') != (before is not None)
+    query = query.order_by(*([column.desc(), key.desc()] if descending else [column.asc(), key.asc()]))
+    rows = query.limit(ROWS_PER_PAGE + 1).all()
+    more = len(rows) > ROWS_PER_PAGE
+    rows = rows[:ROWS_PER_PAGE]
+    if before is not None:
+        rows.reverse()
+    has_next = before is not None or more
+    has_previous = after is not None or (before is not None and more)
+    return TablePage(name, rows, sort, order, rows[-1].id if rows and has_next else None, rows[0].id if rows and has_previous else None)
+
+# Get one page of users
+def users_table(args):
+    columns = {'id': User.id, 'name': User.name, 'username': User.username, 'email': User.email}
+    return table_page('users', User.query, columns, args)
+
+# Get one page of categories, as (category, number of products) rows
+def categories_table(args):
+    table = table_page('categories', Category.query, {'id': Category.id, 'name': Category.name}, args)
+    # Count the products of the categories on this page only
+    counts = dict(
+        db.session.query(Product.category_id, func.count(Product.id))
+        .filter(Product.category_id.in_([category.id for category in table.rows]))
+        .group_by(Product.category_id)
+        .all()
+    )
+    return table._replace(rows=[(category, counts.get(category.id, 0)) for category in table.rows])
+
+# Get one page of products with their category names, filtered by name,
+# category name and stock
+def products_table(args):
+    query = Product.query.join(Product.category).options(contains_eager(Product.category))
+    if args.get('name'):
+        query = filter_product_name(query, args.get('name'))
+    if args.get('category'):
+        query = query.filter(Product.category_id.in_(select(search_categories(args.get('category')).subquery().c.id)))
+    stock = args.get('stock')
+    if stock == 'out':
+        query = query.filter(Product.quantity <= 0)
+    elif stock == 'low':
+        query = query.filter(Product.quantity > 0, Product.quantity < LOW_STOCK)
+    elif stock == 'in':
+        query = query.filter(Product.quantity > 0)
+    columns = {
+        'id': Product.id,
+        'name': Product.name,
+        'category': Category.name,
+        'price': Product.price,
+        'quantity': Product.quantity,
+        'manufacture_date': Product.manufacture_date,
+    }
+    return table_page('products', query, columns, args)
+
+# Get one page of low stock events with their products, newest first by default
+def stock_events_table(args):
+    query = LowStockEvent.query.join(LowStockEvent.product).options(contains_eager(LowStockEvent.product))
+    columns = {
+        'id': LowStockEvent.id,
+        'product': Product.name,
+        'quantity': LowStockEvent.quantity,
+        'created_at': LowStockEvent.created_at,
+        'stock': Product.quantity,
+    }
+    return table_page('stock_events', query, columns, args, default_order='desc')
@@ -0,0 +1,135 @@
+from functools import wraps
+from flask import g, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError, NoSuchModuleError
+
+# Raised at startup when the database settings in the environment are not valid
+class ConfigError(Exception):
+    pass
+
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SQLITE_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# Read and check the database settings, returning them as Flask config.
+# Every problem is reported at once, so a bad deployment fails before serving anything.
+def database_config(environ):
+    errors = []
+
+    def number(name, default, minimum=0):
+        value = environ.get(name, '')
+        if value == '':
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            errors.append(f'{name} must be a whole number, not {value!r}')
+            return default
+        if value < minimum:
+            errors.append(f'{name} must be at least {minimum}')
+        return value
+
+    def flag(name, default):
+        value = environ.get(name, '').lower()
+        if value == '':
+            return default
+        if value not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+            errors.append(f'{name} must be true or false, not {value!r}')
+            return default
+        return value in ('1', 'true', 'yes', 'on')
+
+    def choice(name, default, choices):
+        value = environ.get(name, default).upper()
+        if value not in choices:
+            errors.append(f'{name} must be one of {", ".join(choices)}, not {value!r}')
+        return value
+
+    def url(name):
+        value = environ.get(name)
+        if not value:
+            return None
+        try:
+            value = make_url(value)
+            # Finds unknown database types now instead of on first use
+            value.get_dialect()
+            return value
+        except (ArgumentError, NoSuchModuleError, ImportError):
+            errors.append(f'{name} is not a valid database URL')
+            return None
+
+    primary = url('SQLALCHEMY_DATABASE_URI')
+    if not environ.get('SQLALCHEMY_DATABASE_URI'):
+        errors.append('SQLALCHEMY_DATABASE_URI must be set')
+    replica = url('DATABASE_REPLICA_URI')
+
+    # Connection pool of server databases like PostgreSQL
+    pool = {
+        'pool_size': number('DATABASE_POOL_SIZE', 5, minimum=1),
+        'max_overflow': number('DATABASE_MAX_OVERFLOW', 10),
+        'pool_timeout': number('DATABASE_POOL_TIMEOUT', 30),
+        'pool_recycle': number('DATABASE_POOL_RECYCLE', 1800),
+        'pool_pre_ping': flag('DATABASE_POOL_PRE_PING', True),
+    }
+    # Pragmas set on every SQLite connection
+    sqlite = {
+        'journal_mode': choice('SQLITE_JOURNAL_MODE', 'WAL', SQLITE_JOURNAL_MODES),
+        'synchronous': choice('SQLITE_SYNCHRONOUS', 'NORMAL', SQLITE_SYNCHRONOUS),
+        'busy_timeout': number('SQLITE_BUSY_TIMEOUT', 5000),
+        'mmap_size': number('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+    }
+    track_modifications = flag('SQLALCHEMY_TRACK_MODIFICATIONS', False)
+
+    if errors:
+        raise ConfigError('Invalid database configuration:\n  ' + '\n  '.join(errors))
+
+    def engine_options(url):
+        return {} if url.get_backend_name() == 'sqlite' else dict(pool)
+
+    config = {
+        'SQLALCHEMY_DATABASE_URI': primary,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': track_modifications,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(primary),
+        'SQLALCHEMY_BINDS': {},
+        'SQLITE_PRAGMAS': sqlite,
+    }
+    if replica is not None:
+        config['SQLALCHEMY_BINDS']['replica'] = dict(engine_options(replica), url=replica)
+    return config
+
+# Apply the SQLite pragmas to each new connection of the SQLite engines, with
+# the standard driver or aiosqlite
+def sqlite_pragmas(engines, pragmas):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    for engine in engines:
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+
+# Session that sends reads to the replica database, if there is one, during
+# requests marked with replica_reads. Writes and anything run while flushing
+# always go to the primary database.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and getattr(clause, 'is_select', False)
+            and g.get('replica_reads')
+            and 'replica' in self._db.engines
+        ):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+# Decorator for read only views whose queries may use the replica database.
+# Only GET requests use it, so forms posted to the same view read their own writes.
+def replica_reads(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.replica_reads = request.method in ('GET', 'HEAD')
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,100 @@
+from sqlalchemy import event, select, update, delete, func, exists
+from sqlalchemy.orm import Session, with_loader_criteria
+from flask import current_app
+from grocerystore import db
+from grocerystore.models import Product, Category, Cart, Order, OrderHeader, Reservation, StockMovement, LowStockEvent, ProductSales, CategorySales, ProductPair, Recommendation
+from grocerystore.inventory import return_stock, log_movements
+
+# How deleting products and categories treats the orders that refer to them:
+# 'soft' hides the products and categories but keeps them, so order history stays complete,
+# 'cascade' removes them together with their order lines, adjusting the order totals.
+POLICIES = ('soft', 'cascade')
+
+# Hide soft deleted products and categories from every ORM query, unless the
+# query is run with the include_deleted execution option (like order history)
+@event.listens_for(Session, 'do_orm_execute')
+def hide_deleted(execute_state):
+    if (
+        execute_state.is_select
+        and not execute_state.is_column_load
+        and not execute_state.is_relationship_load
+        and not execute_state.execution_options.get('include_deleted', False)
+    ):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(Product, Product.deleted == False, include_aliases=True),
+            with_loader_criteria(Category, Category.deleted == False, include_aliases=True),
+        )
+
+# Remove products from the catalog with a fixed number of statements, in one transaction.
+# products is a select of the product ids to delete.
+def remove_products(products, policy):
+    # Carts can't hold products that are gone
+    db.session.execute(delete(Cart).where(Cart.product_id.in_(products)))
+    held = db.session.execute(
+        delete(Reservation).where(Reservation.product_id.in_(products)).returning(Reservation.user_id, Reservation.product_id, Reservation.quantity)
+    ).all()
+    if policy == 'soft':
+        # Reserved stock goes back to the hidden products, so it's there if they come back
+        if held:
+            db.session.execute(return_stock, [{'product_id': product_id, 'amount': quantity} for _, product_id, quantity in held])
+            for user_id in {user_id for user_id, _, _ in held}:
+                log_movements([(product_id, quantity, 'release') for owner, product_id, quantity in held if owner == user_id], user_id)
+        db.session.execute(update(Product).where(Product.id.in_(products)).values(deleted=True), execution_options={'synchronize_session': False})
+        return
+
+    # Take the deleted lines out of their order totals, then delete the lines
+    # and any orders left without lines
+    removed = select(func.sum(Order.price * Order.quantity)).where(Order.header_id == OrderHeader.id, Order.product_id.in_(products)).scalar_subquery()
+    affected = select(Order.header_id).where(Order.product_id.in_(products))
+    db.session.execute(
+        update(OrderHeader).where(OrderHeader.id.in_(affected)).values(total=func.round(OrderHeader.total - removed, 2)),
+        execution_options={'synchronize_session': False},
+    )
+    emptied = db.session.scalars(
+        select(OrderHeader.id)
+        .where(OrderHeader.id.in_(affected), ~exists().where(Order.header_id == OrderHeader.id, Order.product_id.not_in(products)))
+        .execution_options(include_deleted=True)
+    ).all()
+    db.session.execute(delete(Order).where(Order.product_id.in_(products)), execution_options={'synchronize_session': False})
+    if emptied:
+        db.session.execute(delete(OrderHeader).where(OrderHeader.id.in_(emptied)), execution_options={'synchronize_session': False})
+    # Sales rollups keep what the products sold, so category and daily totals still include them
+    db.session.execute(delete(ProductSales).where(ProductSales.product_id.in_(products)))
+    db.session.execute(delete(StockMovement).where(StockMovement.product_id.in_(products)))
+    db.session.execute(delete(LowStockEvent).where(LowStockEvent.product_id.in_(products)))
+    # Lists that lose a product are a little short until 'flask recommendations rebuild'
+    for table in (ProductPair, Recommendation):
+        db.session.execute(delete(table).where(table.product_id.in_(products) | table.other_id.in_(products)))
+    db.session.execute(delete(Product).where(Product.id.in_(products)), execution_options={'synchronize_session': False})
+
+# Delete a list of products. Returns the ids of the products that were
+# deleted, leaving out ids that don't exist or were already deleted, and the
+# ids of their categories, so their cached pages can be refreshed.
+def delete_products(product_ids, policy=None):
+    policy = policy or current_app.config['DELETE_POLICY']
+    found = db.session.execute(select(Product.id, Product.category_id).where(Product.id.in_(product_ids))).all()
+    if not found:
+        return [], set()
+    deleted = [product_id for product_id, _ in found]
+    try:
+        remove_products(select(Product.id).where(Product.id.in_(deleted)), policy)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return deleted, {category_id for _, category_id in found}
+
+# Delete a category and all of its products
+def delete_category(category_id, policy=None):
+    policy = policy or current_app.config['DELETE_POLICY']
+    try:
+        remove_products(select(Product.id).where(Product.category_id == category_id), policy)
+        if policy == 'soft':
+            db.session.execute(update(Category).where(Category.id == category_id).values(deleted=True), execution_options={'synchronize_session': False})
+        else:
+            db.session.execute(delete(CategorySales).where(CategorySales.category_id == category_id))
+            db.session.execute(delete(Category).where(Category.id == category_id), execution_options={'synchronize_session': False})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import zlib
+from flask import Response, request, current_app, stream_template, get_flashed_messages
+from jinja2 import FileSystemBytecodeCache
+
+# brotli is optional, without it responses are only compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# How pages get to the browser: large pages are streamed while they render,
+# text responses are compressed with brotli or gzip, whichever the browser
+# prefers, and static files fingerprinted by 'flask assets build' are linked
+# by their hashed names and cached by browsers for good.
+
+# Types of responses that are compressed
+COMPRESSIBLE = ('text/html', 'text/css', 'text/plain', 'text/csv', 'application/json', 'application/javascript', 'application/x-ndjson')
+# Characters of a streamed page sent at a time. Templates stream many tiny
+# pieces, and compressing each one on its own would barely compress them.
+STREAM_CHUNK = 8192
+# Fingerprinted copies of the static files and their manifest, under the static folder
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+# Fingerprinted files never change, so browsers can keep them for a year without asking
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Compressors with the same interface for both encodings: compress some data,
+# flush what is compressed so far so it can be sent, and finish the stream
+class GzipCompressor:
+    def __init__(self, config):
+        self.compressor = zlib.compressobj(config['GZIP_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self, config):
+        self.compressor = brotli.Compressor(quality=config['BROTLI_QUALITY'])
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+# Encodings this process can produce, in order of preference
+def encodings():
+    return {'br': BrotliCompressor, 'gzip': GzipCompressor} if brotli else {'gzip': GzipCompressor}
+
+# Join the pieces a template streams into chunks of about size characters
+def buffered(pieces, size=STREAM_CHUNK):
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+# Send a page while it renders instead of building it all in memory first.
+# Only for pages that are not cached or filled in after rendering.
+def stream_page(template_name, **context):
+    # The session is saved before the body is sent, so the flashed messages
+    # shown by the page must be taken from it now
+    get_flashed_messages()
+    return Response(buffered(stream_template(template_name, **context)), mimetype='text/html')
+
+# Compress a streamed body chunk by chunk, sending each chunk as soon as it is compressed
+def compress_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# Compress a response with the encoding the browser prefers, if it accepts any
+def compress_response(response):
+    config = current_app.config
+    if not config['COMPRESS'] or response.status_code != 200 or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE:
+        return response
+    # Files are sent straight from disk, so only the small static ones are compressed here
+    if response.direct_passthrough and request.endpoint != 'static':
+        return response
+    response.vary.add('Accept-Encoding')
+    available = encodings()
+    encoding = request.accept_encodings.best_match(available)
+    if encoding is None:
+        return response
+    compressor = available[encoding](config)
+
+    if response.is_streamed and request.endpoint != 'static':
+        response.response = compress_stream(response.iter_encoded(), compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    # A range of the file means nothing in the compressed body
+    response.headers.pop('Accept-Ranges', None)
+    # The body differs per encoding, but it is still the same page for If-None-Match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Copy every static file into the build folder with a hash of its contents in
+# its name, and write the manifest of the names. Earlier copies are kept, so
+# pages still open in browsers can load them. Returns the manifest.
+def build_assets(static_folder):
+    build = os.path.join(static_folder, BUILD_DIR)
+    os.makedirs(build, exist_ok=True)
+    manifest = {}
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        subdirectories[:] = [name for name in subdirectories if os.path.join(directory, name) != build]
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()[:12]
+            root, extension = posixpath.splitext(name)
+            manifest[name] = f'{BUILD_DIR}/{root}.{digest}{extension}'
+            target = os.path.join(static_folder, *manifest[name].split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+    # Replaced in one step, so a worker starting meanwhile never reads half of it
+    with open(os.path.join(build, MANIFEST + '.tmp'), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(os.path.join(build, MANIFEST + '.tmp'), os.path.join(build, MANIFEST))
+    return manifest
+
+# Read the manifest written by build_assets, or nothing before the first build
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+# Link static files by their fingerprinted names, when they have one
+def fingerprint(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = current_app.extensions['static_manifest'].get(values['filename'], values['filename'])
+
+# Let browsers keep fingerprinted files
+def cache_static(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304) and request.view_args['filename'] in current_app.extensions['static_files']:
+        response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+def init_app(app):
+    manifest = load_manifest(app.static_folder)
+    app.extensions['static_manifest'] = manifest
+    app.extensions['static_files'] = set(manifest.values())
+    app.url_defaults(fingerprint)
+    # Registered first so it runs after the other after_request functions
+    app.after_request(compress_response)
+    app.after_request(cache_static)
+    # Compiled templates are shared by worker processes, so new workers don't compile them again
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])}
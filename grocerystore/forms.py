@@ -1,9 +1,9 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from flask_login import current_user
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, FloatField, IntegerField, DateField, SelectField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
 from grocerystore.models import User, Category, Product
-from grocerystore import app
 
 # Registration Form
 class RegistrationForm(FlaskForm):
@@ -76,4 +76,10 @@ class ProductForm(FlaskForm):
 
 # Update Product Form
 class UpdateProductForm(ProductForm):
-    submit = SubmitField('Update Product')
\ No newline at end of file
+    submit = SubmitField('Update Product')
+
+# Catalog Import Form
+class CatalogImportForm(FlaskForm):
+    file = FileField('Catalog File (CSV or JSON Lines)', validators=[FileRequired(), FileAllowed(['csv', 'jsonl', 'json'])])
+    create_categories = BooleanField('Create missing categories')
+    submit = SubmitField('Import')
\ No newline at end of file
@@ -0,0 +1,27 @@
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from grocerystore import db
+from grocerystore.models import OrderHeader, Order
+from grocerystore.catalog import split_page
+from grocerystore.archive import archived_orders, archived_total
+
+# Number of orders shown per page of order history
+ORDERS_PER_PAGE = 10
+
+# Get one page of a user's orders, newest first, starting before the given order id
+def get_order_history(user_id, before=None, limit=ORDERS_PER_PAGE):
+    # Load the lines and their products for the whole page at once,
+    # including products that were deleted since
+    query = OrderHeader.query.options(selectinload(OrderHeader.lines).joinedload(Order.product)).execution_options(include_deleted=True).filter_by(user_id=user_id)
+    if before:
+        query = query.filter(OrderHeader.id < before)
+    orders = query.order_by(OrderHeader.id.desc()).limit(limit + 1).all()
+    if len(orders) <= limit:
+        # Past the live orders, the page goes on with archived ones, which are all older
+        orders += archived_orders(user_id, before=orders[-1].id if orders else before, limit=limit + 1 - len(orders))
+    return split_page(orders, limit)
+
+# Get the total a user has spent over all orders
+def get_grand_total(user_id):
+    # Only reads the (user_id, id, total) index, and the user's archived totals
+    return db.session.query(func.coalesce(func.sum(OrderHeader.total), 0) + archived_total(user_id)).filter(OrderHeader.user_id == user_id).scalar()
@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, insert, delete, bindparam, literal
+from grocerystore import db
+from grocerystore.models import Product, Reservation, StockMovement, LowStockEvent
+from grocerystore.dashboard import LOW_STOCK
+
+# Stock is held for a cart line as soon as it is added, for RESERVATION_TTL
+# seconds after the cart last changed. Product.quantity is the stock still
+# available to new carts, so reserving takes stock from it and releasing,
+# expiring or ordering gives back whatever isn't bought. Every change to a
+# product's stock is logged as a stock movement.
+
+logger = logging.getLogger(__name__)
+
+# Raised when a product doesn't have enough stock left
+class OutOfStock(Exception):
+    pass
+
+products = Product.__table__
+
+# Take stock from a product, but only where enough stock is left. The check and
+# the decrement happen in the same statement, so two concurrent carts or
+# checkouts can't both take the last items.
+take_stock = update(products).where(
+    products.c.id == bindparam('product_id'),
+    products.c.quantity >= bindparam('amount'),
+).values(quantity=products.c.quantity - bindparam('amount'))
+
+# Give stock back to a product
+return_stock = update(products).where(products.c.id == bindparam('product_id')).values(quantity=products.c.quantity + bindparam('amount'))
+
+# Whether carts reserve stock
+def reservations_enabled():
+    return current_app.config['RESERVATION_TTL'] > 0
+
+# Log changes to the stock of products, given as (product_id, change, reason), after
+# they are made. The stock after each change is read by the insert itself, and a
+# change that takes a product below LOW_STOCK records a low stock event. Both are
+# one statement for any number of changes.
+def log_movements(movements, user_id=None):
+    movements = [{'moved_product': product_id, 'moved_change': change, 'moved_reason': reason} for product_id, change, reason in movements if change]
+    if not movements:
+        return
+    now = datetime.utcnow()
+    change = bindparam('moved_change', type_=db.Integer)
+    db.session.execute(
+        insert(StockMovement.__table__).from_select(
+            ['product_id', 'change', 'quantity', 'reason', 'user_id', 'created_at'],
+            select(products.c.id, change, products.c.quantity, bindparam('moved_reason', type_=db.String), literal(user_id, db.Integer), literal(now, db.DateTime))
+            .where(products.c.id == bindparam('moved_product')),
+        ),
+        movements,
+    )
+    falling = [movement for movement in movements if movement['moved_change'] < 0]
+    if falling:
+        db.session.execute(
+            insert(LowStockEvent.__table__).from_select(
+                ['product_id', 'quantity', 'created_at'],
+                select(products.c.id, products.c.quantity, literal(now, db.DateTime))
+                .where(products.c.id == bindparam('moved_product'), products.c.quantity < LOW_STOCK, products.c.quantity - change >= LOW_STOCK),
+            ),
+            [{'moved_product': movement['moved_product'], 'moved_change': movement['moved_change']} for movement in falling],
+        )
+
+# Get a user's reservations of some products as {product_id: quantity}. Expired
+# reservations the sweeper hasn't reached yet still hold their stock, so they count.
+def reserved(user_id, product_ids):
+    return dict(db.session.execute(
+        select(Reservation.product_id, Reservation.quantity).where(Reservation.user_id == user_id, Reservation.product_id.in_(product_ids))
+    ).all())
+
+# Get a user's reservations of some products that haven't expired yet, as
+# {product_id: quantity}. This is the stock the user can count on keeping.
+def unexpired_reservations(user_id, product_ids, now=None):
+    return dict(db.session.execute(
+        select(Reservation.product_id, Reservation.quantity)
+        .where(Reservation.user_id == user_id, Reservation.product_id.in_(product_ids), Reservation.expires_at >= (now or datetime.utcnow()))
+    ).all())
+
+# Reserve stock for a user's cart in the caller's transaction. quantities maps product
+# ids to the new quantities in the cart, and snapshots maps them to the products, which
+# are passed to OutOfStock. Reservations of these products are renewed.
+def reserve(user_id, quantities, snapshots):
+    held = reserved(user_id, quantities)
+    movements = []
+    for product_id, quantity in quantities.items():
+        change = quantity - held.get(product_id, 0)
+        if change > 0:
+            if db.session.execute(take_stock, {'product_id': product_id, 'amount': change}).rowcount != 1:
+                raise OutOfStock(snapshots[product_id])
+            movements.append((product_id, -change, 'reserve'))
+        elif change < 0:
+            db.session.execute(return_stock, {'product_id': product_id, 'amount': -change})
+            movements.append((product_id, -change, 'release'))
+
+    expires_at = datetime.utcnow() + timedelta(seconds=current_app.config['RESERVATION_TTL'])
+    renewed = [{'product': product_id, 'amount': quantity} for product_id, quantity in quantities.items() if product_id in held and quantity]
+    if renewed:
+        db.session.execute(
+            update(Reservation.__table__)
+            .where(Reservation.__table__.c.user_id == user_id, Reservation.__table__.c.product_id == bindparam('product'))
+            .values(quantity=bindparam('amount'), expires_at=expires_at),
+            renewed,
+        )
+    added = [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity, 'expires_at': expires_at} for product_id, quantity in quantities.items() if product_id not in held and quantity]
+    if added:
+        db.session.execute(insert(Reservation), added)
+    emptied = [product_id for product_id, quantity in quantities.items() if product_id in held and not quantity]
+    if emptied:
+        db.session.execute(delete(Reservation).where(Reservation.user_id == user_id, Reservation.product_id.in_(emptied)))
+    log_movements(movements, user_id)
+
+# Give back the stock a user reserved for some products, or for every product
+# when product_ids is None, in the caller's transaction
+def release(user_id, product_ids=None):
+    statement = delete(Reservation).where(Reservation.user_id == user_id)
+    if product_ids is not None:
+        statement = statement.where(Reservation.product_id.in_(product_ids))
+    released = db.session.execute(statement.returning(Reservation.product_id, Reservation.quantity)).all()
+    if released:
+        db.session.execute(return_stock, [{'product_id': product_id, 'amount': quantity} for product_id, quantity in released])
+        log_movements([(product_id, quantity, 'release') for product_id, quantity in released], user_id)
+
+# Take the stock for an order of lines ({product_id: quantity}) in the caller's
+# transaction. What the user reserved is used first and only the rest is taken
+# from the product, then the reservations are removed.
+def take_for_order(user_id, lines):
+    held = reserved(user_id, lines) if reservations_enabled() else {}
+    needed = {product_id: quantity - held.get(product_id, 0) for product_id, quantity in lines.items()}
+    taken = [{'product_id': product_id, 'amount': amount} for product_id, amount in needed.items() if amount > 0]
+    if taken:
+        result = db.session.execute(take_stock, taken)
+        # Every line must have updated exactly one product
+        if result.rowcount != len(taken):
+            raise OutOfStock()
+    # Reservations larger than the cart lines, if they ever got out of step, give back the rest
+    returned = [{'product_id': product_id, 'amount': -amount} for product_id, amount in needed.items() if amount < 0]
+    if returned:
+        db.session.execute(return_stock, returned)
+    if held:
+        db.session.execute(delete(Reservation).where(Reservation.user_id == user_id, Reservation.product_id.in_(held)))
+    # The reserved part was logged when it was reserved
+    log_movements([(product_id, -amount, 'order') for product_id, amount in needed.items()], user_id)
+
+# Give back the stock of reservations that expired before now, a batch at a
+# time, returning how many expired. Each reservation is only expired if it
+# wasn't renewed in the meantime.
+def expire_reservations(now=None, batch_size=1000):
+    now = now or datetime.utcnow()
+    count = 0
+    while True:
+        expired = db.session.execute(
+            select(Reservation.id, Reservation.user_id, Reservation.product_id, Reservation.quantity)
+            .where(Reservation.expires_at < now)
+            .order_by(Reservation.expires_at)
+            .limit(batch_size)
+        ).all()
+        if not expired:
+            return count
+        returned = []
+        for reservation in expired:
+            if db.session.execute(delete(Reservation).where(Reservation.id == reservation.id, Reservation.expires_at < now)).rowcount:
+                returned.append(reservation)
+        if returned:
+            db.session.execute(return_stock, [{'product_id': reservation.product_id, 'amount': reservation.quantity} for reservation in returned])
+            for user_id in {reservation.user_id for reservation in returned}:
+                log_movements([(reservation.product_id, reservation.quantity, 'expire') for reservation in returned if reservation.user_id == user_id], user_id)
+        db.session.commit()
+        count += len(returned)
+
+# Expire reservations of an app every RESERVATION_SWEEP_INTERVAL seconds, forever
+def sweep_reservations(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                count = expire_reservations()
+            if count:
+                logger.info('Expired %d reservations', count)
+        except Exception:
+            logger.exception('Expiring reservations failed')
+
+# Start the sweeper thread of the app, if it isn't running in this process.
+# Forked worker processes don't inherit threads, so each one starts its own
+# on its first request.
+def start_sweeper():
+    sweeper = current_app.extensions['reservation_sweeper']
+    interval = current_app.config['RESERVATION_SWEEP_INTERVAL']
+    if sweeper['pid'] == os.getpid() or not interval or not reservations_enabled():
+        return
+    with sweeper['lock']:
+        if sweeper['pid'] != os.getpid():
+            threading.Thread(target=sweep_reservations, args=(current_app._get_current_object(), interval), name='reservation-sweeper', daemon=True).start()
+            sweeper['pid'] = os.getpid()
+
+def init_app(app):
+    app.extensions['reservation_sweeper'] = {'pid': None, 'lock': threading.Lock()}
+    app.before_request(start_sweeper)
@@ -0,0 +1,243 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+from flask import request, current_app
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+# fcntl is only there on Unix, which the shared store needs
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Requests that write (sign ins, registrations and cart changes) take a token
+# from a bucket per client, refilled at a steady rate up to the bucket size,
+# and are refused with 429 and Retry-After when a bucket is empty. Buckets are
+# kept per process ('memory') or in a file mapped into every worker process on
+# the machine ('shared'). Each kind of request also has a cap on how many run
+# at once in a process, beyond which they fail fast with 503, like password hashing.
+
+# Raised when a client has used up its requests for now, answered with 429 and Retry-After
+class RateLimited(TooManyRequests):
+    description = 'Too many requests. Please slow down and try again in a moment.'
+
+# Raised when too many requests of a kind are already running in this process, answered with 503
+class Overloaded(ServiceUnavailable):
+    description = 'Too many requests right now. Please try again in a moment.'
+
+# The email address a sign in or registration is for, from the form or the JSON body
+def submitted_email():
+    email = request.form.get('email') or (request.get_json(silent=True) or {}).get('email')
+    return email.strip().lower() if isinstance(email, str) else None
+
+# Token buckets of each kind of request, as (limit setting, name, key of the client).
+# The client address is the connection's, so behind a proxy use ProxyFix.
+RULES = {
+    'auth': [
+        ('AUTH_RATE_LIMIT', 'ip', lambda: request.remote_addr),
+    ],
+    'cart': [
+        ('CART_RATE_LIMIT', 'user', lambda: current_user.id),
+    ],
+}
+
+# Token buckets only charged when the view reports a failure with failed(),
+# like a sign in with the wrong password, so no one can use up another user's
+# sign ins by sending their email. An empty one still refuses the request.
+FAILURE_RULES = {
+    'auth': [
+        ('ACCOUNT_RATE_LIMIT', 'account', submitted_email),
+    ],
+}
+
+# Setting with the most requests of each kind running at once per process
+CONCURRENCY = {'auth': 'AUTH_CONCURRENCY', 'cart': 'CART_CONCURRENCY'}
+
+# Parse a limit like '20/60' (20 requests, refilled over 60 seconds) into the
+# bucket size and tokens added per second, or None for '0' (no limit)
+def parse_limit(value):
+    if value in ('0', ''):
+        return None
+    size, seconds = value.split('/')
+    return int(size), int(size) / float(seconds)
+
+# Take cost tokens (1, or 0 to only check) from a bucket of size tokens refilled
+# at rate tokens per second, given as (tokens, time of the last update). Returns
+# the new state and how many seconds to wait, 0 when a token was there.
+def take_token(state, size, rate, now, cost=1):
+    tokens, updated = state if state else (size, now)
+    tokens = min(size, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return (tokens - cost, now), 0
+    return (tokens, now), (1 - tokens) / rate
+
+# Buckets kept in the memory of one process, dropping the least recently used
+class MemoryBuckets:
+    def __init__(self, size):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def take(self, key, size, rate, cost=1):
+        with self.lock:
+            # Checking a bucket that isn't there doesn't make one
+            if not cost and key not in self.buckets:
+                return 0
+            self.buckets[key], wait = take_token(self.buckets.get(key), size, rate, time.time(), cost)
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return wait
+
+# Buckets kept in a file of fixed size slots, mapped into the memory of every
+# worker process. A key goes in the slot its hash points to, or one of the
+# next few; when they are all taken, the one updated longest ago is reused.
+# A lock on the file is held only while one slot is read and written.
+class SharedBuckets:
+    # Hash of the key (0 for a free slot), tokens and time of the last update
+    slot = struct.Struct('=Qdd')
+    # Slots tried for each key
+    probes = 4
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self.pid = None
+        self.lock = Lock()
+
+    # Open the file in each process, since locks on a file opened before a fork are shared with it
+    def open(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    if fcntl is None:
+                        raise RuntimeError("RATE_LIMITS = 'shared' needs fcntl, use 'memory' on this platform")
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    if os.fstat(fd).st_size < self.slots * self.slot.size:
+                        os.ftruncate(fd, self.slots * self.slot.size)
+                    self.map = mmap.mmap(fd, self.slots * self.slot.size)
+                    self.fd = fd
+                    self.pid = os.getpid()
+        return self
+
+    def take(self, key, size, rate, cost=1):
+        self.open()
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        first = digest % self.slots
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                found = None
+                oldest = None
+                for probe in range(self.probes):
+                    offset = (first + probe) % self.slots * self.slot.size
+                    owner, tokens, updated = self.slot.unpack_from(self.map, offset)
+                    if owner == digest:
+                        found, state = offset, (tokens, updated)
+                        break
+                    if owner == 0:
+                        found, state = offset, None
+                        break
+                    if oldest is None or updated < oldest[1]:
+                        oldest = (offset, updated)
+                if found is None:
+                    found, state = oldest[0], None
+                # Checking a bucket that isn't there doesn't take a slot
+                if state is None and not cost:
+                    return 0
+                state, wait = take_token(state, size, rate, now, cost)
+                self.slot.pack_into(self.map, found, digest, *state)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return wait
+
+# Create the bucket store chosen in the config
+def create_store(config):
+    backend = config['RATE_LIMITS']
+    if backend == 'memory':
+        return MemoryBuckets(config['RATE_LIMIT_SLOTS'])
+    if backend == 'shared':
+        return SharedBuckets(config['RATE_LIMIT_FILE'], config['RATE_LIMIT_SLOTS'])
+    if backend == 'none':
+        return None
+    raise ValueError(f'Unknown RATE_LIMITS backend: {backend}')
+
+def init_app(app):
+    app.extensions['rate_limits'] = {
+        'store': create_store(app.config),
+        'limits': {setting: parse_limit(app.config[setting]) for rules in (*RULES.values(), *FAILURE_RULES.values()) for setting, _, _ in rules},
+        'running': {kind: BoundedSemaphore(app.config[setting]) if app.config[setting] else None for kind, setting in CONCURRENCY.items()},
+    }
+
+# Rate limiting metrics
+stats = {
+    'limited': 0,
+    'overloaded': 0,
+}
+stats_lock = Lock()
+
+# The buckets of the client for some rules of a kind of request, as (bucket key, limit)
+def client_buckets(kind, rules):
+    limits = current_app.extensions['rate_limits']['limits']
+    for setting, name, key in rules.get(kind, []):
+        limit = limits[setting]
+        client = key() if limit else None
+        if client:
+            yield f'{kind}:{name}:{client}', limit
+
+# Take a token from every bucket of the client for a kind of request, and check
+# its failure buckets without charging them, raising RateLimited with the
+# longest wait if any of them is empty
+def check(kind):
+    store = current_app.extensions['rate_limits']['store']
+    if store is None:
+        return
+    wait = 0
+    for rules, cost in ((RULES, 1), (FAILURE_RULES, 0)):
+        for bucket, limit in client_buckets(kind, rules):
+            wait = max(wait, store.take(bucket, *limit, cost))
+    if wait:
+        with stats_lock:
+            stats['limited'] += 1
+        raise RateLimited(retry_after=math.ceil(wait))
+
+# Charge the failure buckets of the client, for a request of a kind that failed
+def failed(kind):
+    store = current_app.extensions['rate_limits']['store']
+    if store is None:
+        return
+    for bucket, limit in client_buckets(kind, FAILURE_RULES):
+        store.take(bucket, *limit)
+
+# Limit the requests of a view that change something (anything but GET and
+# HEAD) with the buckets and concurrency cap of a kind of request. Goes below
+# login_required, so cart buckets are per user.
+def rate_limited(kind):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method in ('GET', 'HEAD'):
+                return f(*args, **kwargs)
+            check(kind)
+            running = current_app.extensions['rate_limits']['running'][kind]
+            if running is None:
+                return f(*args, **kwargs)
+            if not running.acquire(blocking=False):
+                with stats_lock:
+                    stats['overloaded'] += 1
+                raise Overloaded(retry_after=1)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                running.release()
+        return decorated_function
+    return decorator
@@ -0,0 +1,208 @@
+import logging
+import re
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+from flask import g, request, current_app, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from grocerystore import db
+
+# Where the time of each request goes: SQL statements, template rendering and
+# password hashing, collected per endpoint from SQLAlchemy engine events and
+# Flask request hooks. Totals are kept per process, like the other caches.
+
+logger = logging.getLogger(__name__)
+
+# Raised in the query that goes over QUERY_BUDGET, when QUERY_BUDGET_ACTION is 'raise'
+class QueryBudgetExceeded(Exception):
+    pass
+
+# Upper bounds in seconds of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+# Number of slowest statements kept
+SLOWEST = 10
+
+# Per endpoint totals
+totals = defaultdict(lambda: {
+    'requests': 0,
+    'errors': 0,
+    'seconds': 0.0,
+    'queries': 0,
+    'sql_seconds': 0.0,
+    'template_seconds': 0.0,
+    'bcrypt_seconds': 0.0,
+    'buckets': [0] * len(BUCKETS),
+})
+# The slowest statements seen, as (seconds, endpoint, statement)
+slowest = []
+lock = Lock()
+
+# Collapse a statement to one line, so it can be shown and grouped
+def normalize(statement):
+    return re.sub(r'\s+', ' ', statement).strip()[:200]
+
+# Add time spent on something (like 'bcrypt') to the current request
+def add_time(name, seconds):
+    if has_request_context() and 'timings' in g:
+        g.timings[name] += seconds
+
+def start_request():
+    g.request_start = time.perf_counter()
+    g.timings = Counter()
+    g.queries = 0
+    g.statements = Counter()
+    g.template_starts = []
+
+def start_query(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_starts', []).append(time.perf_counter())
+
+def failed_query(context):
+    if context.connection is not None and context.connection.info.get('query_starts'):
+        context.connection.info['query_starts'].pop()
+
+def end_query(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['query_starts'].pop()
+    if not has_request_context() or 'timings' not in g:
+        return
+    g.queries += 1
+    g.timings['sql'] += elapsed
+    endpoint = request.endpoint or 'unknown'
+    if not slowest or elapsed > slowest[-1][0] or len(slowest) < SLOWEST:
+        with lock:
+            slowest.append((elapsed, endpoint, normalize(statement)))
+            slowest.sort(key=lambda item: item[0], reverse=True)
+            del slowest[SLOWEST:]
+
+    budget = current_app.config['QUERY_BUDGET']
+    if budget:
+        g.statements[normalize(statement)] += 1
+        if g.queries == budget + 1 and current_app.config['QUERY_BUDGET_ACTION'] == 'raise':
+            raise QueryBudgetExceeded(f'{endpoint} ran more than {budget} queries, most repeated: {repeated_statements(g.statements)}')
+
+def start_template(sender, template, context, **extra):
+    if 'template_starts' in g:
+        g.template_starts.append(time.perf_counter())
+
+def end_template(sender, template, context, **extra):
+    if g.get('template_starts'):
+        elapsed = time.perf_counter() - g.template_starts.pop()
+        # Templates rendered inside another one's render count only once
+        if not g.template_starts:
+            g.timings['template'] += elapsed
+
+# The statements run most often in this request, the usual sign of N+1 queries
+def repeated_statements(statements):
+    return '; '.join(f'{count}x {statement}' for statement, count in statements.most_common(3))
+
+# Add a finished request to the totals, given its g, and log it if it went
+# over the query budget. Returns how long it took.
+def record_request(state, endpoint, status_code, budget):
+    elapsed = time.perf_counter() - state.request_start
+    if budget and state.queries > budget:
+        logger.warning('%s ran %d queries, over the budget of %d. Most repeated: %s', endpoint, state.queries, budget, repeated_statements(state.statements))
+
+    with lock:
+        row = totals[endpoint]
+        row['requests'] += 1
+        row['errors'] += status_code >= 500
+        row['seconds'] += elapsed
+        row['queries'] += state.queries
+        row['sql_seconds'] += state.timings['sql']
+        row['template_seconds'] += state.timings['template']
+        row['bcrypt_seconds'] += state.timings['bcrypt']
+        for n, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                row['buckets'][n] += 1
+                break
+    return elapsed
+
+# A streamed body, like a page from stream_page, renders and queries after
+# this runs, so the request is recorded once the body is sent. Its headers
+# are already gone by then, so it gets no Server-Timing header. Files sent
+# straight from disk are recorded here.
+def end_request(response):
+    if 'request_start' not in g:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    budget = current_app.config['QUERY_BUDGET']
+
+    if response.is_streamed and not response.direct_passthrough:
+        state, status_code = g._get_current_object(), response.status_code
+        response.call_on_close(lambda: record_request(state, endpoint, status_code, budget))
+        return response
+
+    elapsed = record_request(g, endpoint, response.status_code, budget)
+    if current_app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={g.timings["sql"] * 1000:.1f};desc="{g.queries} queries"',
+            f'tpl;dur={g.timings["template"] * 1000:.1f}',
+            f'bcrypt;dur={g.timings["bcrypt"] * 1000:.1f}',
+            f'total;dur={elapsed * 1000:.1f}',
+        ])
+    return response
+
+# Count and time the SQL statements an engine runs for requests
+def watch_engine(engine):
+    event.listen(engine, 'before_cursor_execute', start_query)
+    event.listen(engine, 'handle_error', failed_query)
+    event.listen(engine, 'after_cursor_execute', end_query)
+
+# Collect metrics for an app's requests and database engines
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(end_request)
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(end_template, app)
+    with app.app_context():
+        for engine in db.engines.values():
+            watch_engine(engine)
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+# Metrics in the Prometheus text format. extra is a list of (name, type, help, value)
+# for metrics kept elsewhere, like password hashing.
+def prometheus_text(extra=()):
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP grocerystore_{name} {help}')
+        lines.append(f'# TYPE grocerystore_{name} {kind}')
+        for labels, value in samples:
+            labels = ','.join(f'{key}="{label(value)}"' for key, value in labels.items())
+            lines.append(f'grocerystore_{name}{{{labels}}} {value}' if labels else f'grocerystore_{name} {value}')
+
+    with lock:
+        rows = {endpoint: dict(row, buckets=list(row['buckets'])) for endpoint, row in totals.items()}
+        slow = list(slowest)
+
+    per_endpoint = [
+        ('requests_total', 'counter', 'Requests handled.', 'requests'),
+        ('request_errors_total', 'counter', 'Requests that failed with a server error.', 'errors'),
+        ('sql_queries_total', 'counter', 'SQL statements run.', 'queries'),
+        ('sql_seconds_total', 'counter', 'Time spent running SQL statements.', 'sql_seconds'),
+        ('template_seconds_total', 'counter', 'Time spent rendering templates.', 'template_seconds'),
+        ('bcrypt_seconds_total', 'counter', 'Time spent hashing and checking passwords.', 'bcrypt_seconds'),
+    ]
+    for name, kind, help, key in per_endpoint:
+        metric(name, kind, help, [({'endpoint': endpoint}, row[key]) for endpoint, row in rows.items()])
+
+    samples = []
+    for endpoint, row in rows.items():
+        count = 0
+        for bound, hits in zip(BUCKETS, row['buckets']):
+            count += hits
+            samples.append(({'endpoint': endpoint, 'le': '+Inf' if bound == float('inf') else bound}, count))
+    lines.append('# HELP grocerystore_request_duration_seconds Time taken by requests.')
+    lines.append('# TYPE grocerystore_request_duration_seconds histogram')
+    for labels, value in samples:
+        lines.append(f'grocerystore_request_duration_seconds_bucket{{endpoint="{label(labels["endpoint"])}",le="{labels["le"]}"}} {value}')
+    for endpoint, row in rows.items():
+        lines.append(f'grocerystore_request_duration_seconds_sum{{endpoint="{label(endpoint)}"}} {row["seconds"]}')
+        lines.append(f'grocerystore_request_duration_seconds_count{{endpoint="{label(endpoint)}"}} {row["requests"]}')
+
+    metric('slow_query_seconds', 'gauge', f'The {SLOWEST} slowest SQL statements.',
+           [({'endpoint': endpoint, 'statement': statement}, seconds) for seconds, endpoint, statement in slow])
+    for name, kind, help, value in extra:
+        metric(name, kind, help, [({}, value)])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,333 @@
+import sqlalchemy as sa
+from sqlalchemy import select, insert, update, delete, func, inspect, text
+from sqlalchemy.exc import OperationalError
+from grocerystore import db
+from grocerystore.search import search_index_ddl
+
+# Versioned schema changes. Each migration upgrades the schema by one version
+# and is recorded in the schema_version table in the same transaction, so a
+# database is always at exactly one version. Migrations describe the tables as
+# they were at that version instead of using the models, which keep changing.
+#
+# Migrations 2 to 4 check what already exists before changing anything, because
+# databases from before this table existed may have some of those changes.
+
+schema_version = sa.Table('schema_version', sa.MetaData(), sa.Column('version', sa.Integer, nullable=False))
+
+def has_column(connection, table, name):
+    return name in [column['name'] for column in inspect(connection).get_columns(table)]
+
+# The tables as the first release created them
+def initial_schema(connection):
+    metadata = sa.MetaData()
+    sa.Table('user', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(32), nullable=False),
+        sa.Column('username', sa.String(16), unique=True, nullable=False),
+        sa.Column('email', sa.String(64), unique=True, nullable=False),
+        sa.Column('is_admin', sa.Boolean, nullable=False),
+        sa.Column('password', sa.String(256), nullable=False),
+    )
+    sa.Table('category', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(64), nullable=False),
+    )
+    sa.Table('product', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(64), nullable=False),
+        sa.Column('price', sa.Float, nullable=False),
+        sa.Column('category_id', sa.Integer, sa.ForeignKey('category.id'), nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+        sa.Column('manufacture_date', sa.Date, nullable=False),
+    )
+    sa.Table('cart', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+    )
+    sa.Table('order', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+        sa.Column('price', sa.Float, nullable=False),
+        sa.Column('datetime_ordered', sa.DateTime, nullable=False),
+    )
+    metadata.create_all(connection)
+
+# Orders get a header row per checkout, with the order lines pointing to it
+def order_headers(connection):
+    metadata = sa.MetaData()
+    sa.Table('user', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    header = sa.Table('order_header', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('total', sa.Float, nullable=False),
+        sa.Column('datetime_ordered', sa.DateTime, nullable=False),
+        sa.Index('ix_order_header_user_id', 'user_id', 'id', 'total'),
+    )
+    order = sa.Table('order', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('header_id', sa.Integer),
+        sa.Column('user_id', sa.Integer),
+        sa.Column('quantity', sa.Integer),
+        sa.Column('price', sa.Float),
+        sa.Column('datetime_ordered', sa.DateTime),
+        sa.Index('ix_order_header_id', 'header_id'),
+    )
+    header.create(connection, checkfirst=True)
+    if not has_column(connection, 'order', 'header_id'):
+        connection.execute(text('ALTER TABLE "order" ADD COLUMN header_id INTEGER REFERENCES order_header (id)'))
+    for index in order.indexes:
+        index.create(connection, checkfirst=True)
+
+    # Old orders were saved one row per product, so each user and time becomes one order
+    legacy = connection.execute(
+        select(order.c.user_id, order.c.datetime_ordered, func.sum(order.c.price * order.c.quantity))
+        .where(order.c.header_id.is_(None))
+        .group_by(order.c.user_id, order.c.datetime_ordered)
+    ).all()
+    for user_id, ordered, total in legacy:
+        header_id = connection.execute(insert(header).values(user_id=user_id, total=total, datetime_ordered=ordered)).inserted_primary_key[0]
+        connection.execute(
+            update(order)
+            .where(order.c.header_id.is_(None), order.c.user_id == user_id, order.c.datetime_ordered == ordered)
+            .values(header_id=header_id)
+        )
+
+# Products and categories can be soft deleted
+def soft_delete(connection):
+    for table in ('product', 'category'):
+        if not has_column(connection, table, 'deleted'):
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN deleted BOOLEAN NOT NULL DEFAULT 0'))
+
+# Indexes for searching products by name and price, and full text
+# indexes over product and category names where SQLite has FTS5
+def search_indexes(connection):
+    product = sa.Table('product', sa.MetaData(),
+        sa.Column('name', sa.String(64)),
+        sa.Column('price', sa.Float),
+        sa.Index('ix_product_name', 'name'),
+        sa.Index('ix_product_price', 'price'),
+    )
+    for index in product.indexes:
+        index.create(connection, checkfirst=True)
+    if connection.dialect.name != 'sqlite':
+        return
+    for source in ('product', 'category'):
+        if inspect(connection).has_table(f'{source}_search'):
+            continue
+        # Try each index in a savepoint, so a SQLite without FTS5 leaves the
+        # rest of the migration in place and searches fall back to LIKE
+        try:
+            with connection.begin_nested():
+                for statement in search_index_ddl(source):
+                    connection.execute(text(statement))
+        except OperationalError:
+            return
+
+# Indexes for the foreign key lookups made on every page, and one cart line
+# per user and product
+def lookup_indexes(connection):
+    cart = sa.table('cart', sa.column('id'), sa.column('user_id'), sa.column('product_id'), sa.column('quantity'))
+    other = cart.alias('other')
+
+    # Merge duplicate cart lines into the oldest one before making them unique
+    first = select(func.min(cart.c.id)).group_by(cart.c.user_id, cart.c.product_id)
+    duplicated = first.having(func.count() > 1)
+    connection.execute(
+        update(cart)
+        .where(cart.c.id.in_(duplicated))
+        .values(quantity=select(func.sum(other.c.quantity)).where(other.c.user_id == cart.c.user_id, other.c.product_id == cart.c.product_id).scalar_subquery())
+    )
+    connection.execute(delete(cart).where(cart.c.id.not_in(first)))
+
+    metadata = sa.MetaData()
+    sa.Table('cart', metadata,
+        sa.Column('user_id', sa.Integer),
+        sa.Column('product_id', sa.Integer),
+        sa.Index('uq_cart_user_product', 'user_id', 'product_id', unique=True),
+    )
+    sa.Table('order', metadata,
+        sa.Column('id', sa.Integer),
+        sa.Column('user_id', sa.Integer),
+        sa.Index('ix_order_user_id', 'user_id', 'id'),
+    )
+    sa.Table('product', metadata,
+        sa.Column('id', sa.Integer),
+        sa.Column('category_id', sa.Integer),
+        sa.Index('ix_product_category_id', 'category_id', 'id'),
+    )
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection)
+
+# Stock reservations for carts, the stock movement log and low stock events
+def inventory(connection):
+    metadata = sa.MetaData()
+    sa.Table('user', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('product', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('quantity', sa.Integer),
+        sa.Index('ix_product_quantity', 'quantity'),
+    )
+    sa.Table('reservation', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+        sa.Column('expires_at', sa.DateTime, nullable=False),
+        sa.Index('uq_reservation_user_product', 'user_id', 'product_id', unique=True),
+        sa.Index('ix_reservation_expires_at', 'expires_at'),
+    )
+    sa.Table('stock_movement', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('change', sa.Integer, nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+        sa.Column('reason', sa.String(16), nullable=False),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id')),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.Index('ix_stock_movement_product_id', 'product_id', 'id'),
+    )
+    sa.Table('low_stock_event', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False),
+        sa.Column('quantity', sa.Integer, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.Index('ix_low_stock_event_product_id', 'product_id'),
+    )
+    for name in ('reservation', 'stock_movement', 'low_stock_event'):
+        metadata.tables[name].create(connection)
+    for index in metadata.tables['product'].indexes:
+        index.create(connection)
+
+# Sales rollups per product, category and day, and which orders they count
+def sales_rollups(connection):
+    metadata = sa.MetaData()
+    sa.Table('product', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('category', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('product_sales', metadata,
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), primary_key=True),
+        sa.Column('units', sa.Integer, nullable=False),
+        sa.Column('revenue', sa.Float, nullable=False),
+    )
+    sa.Table('category_sales', metadata,
+        sa.Column('category_id', sa.Integer, sa.ForeignKey('category.id'), primary_key=True),
+        sa.Column('units', sa.Integer, nullable=False),
+        sa.Column('revenue', sa.Float, nullable=False),
+    )
+    sa.Table('daily_sales', metadata,
+        sa.Column('day', sa.Date, primary_key=True),
+        sa.Column('orders', sa.Integer, nullable=False),
+        sa.Column('units', sa.Integer, nullable=False),
+        sa.Column('revenue', sa.Float, nullable=False),
+    )
+    for name in ('product_sales', 'category_sales', 'daily_sales'):
+        metadata.tables[name].create(connection)
+    # Existing orders are left to be rolled up by 'flask sales backfill'
+    connection.execute(text('ALTER TABLE order_header ADD COLUMN rolled_up BOOLEAN NOT NULL DEFAULT false'))
+    header = sa.Table('order_header', sa.MetaData(), sa.Column('rolled_up', sa.Boolean), sa.Index('ix_order_header_rolled_up', 'rolled_up'))
+    for index in header.indexes:
+        index.create(connection)
+
+# Pairs of products bought together and the recommendations kept from them
+def recommendations(connection):
+    metadata = sa.MetaData()
+    sa.Table('product', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('product_pair', metadata,
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), primary_key=True),
+        sa.Column('other_id', sa.Integer, sa.ForeignKey('product.id'), primary_key=True, index=True),
+        sa.Column('orders', sa.Integer, nullable=False),
+    )
+    sa.Table('recommendation', metadata,
+        sa.Column('product_id', sa.Integer, sa.ForeignKey('product.id'), primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('other_id', sa.Integer, sa.ForeignKey('product.id'), nullable=False, index=True),
+        sa.Column('orders', sa.Integer, nullable=False),
+    )
+    # Existing orders are left to 'flask recommendations rebuild'
+    for name in ('product_pair', 'recommendation'):
+        metadata.tables[name].create(connection)
+
+# Segment files of archived orders and where each user's orders are in them
+def order_archive(connection):
+    metadata = sa.MetaData()
+    sa.Table('user', metadata, sa.Column('id', sa.Integer, primary_key=True))
+    sa.Table('order_segment', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('filename', sa.String(64), nullable=False),
+        sa.Column('orders', sa.Integer, nullable=False),
+        sa.Column('first_id', sa.Integer, nullable=False),
+        sa.Column('last_id', sa.Integer, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+    )
+    sa.Table('archived_orders', metadata,
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+        sa.Column('segment_id', sa.Integer, sa.ForeignKey('order_segment.id'), primary_key=True),
+        sa.Column('orders', sa.Integer, nullable=False),
+        sa.Column('total', sa.Float, nullable=False),
+        sa.Column('oldest_id', sa.Integer, nullable=False),
+        sa.Column('header_start', sa.Integer, nullable=False),
+        sa.Column('line_start', sa.Integer, nullable=False),
+        sa.Column('line_count', sa.Integer, nullable=False),
+    )
+    for name in ('order_segment', 'archived_orders'):
+        metadata.tables[name].create(connection)
+
+# An index that keeps each product's pairs in ranking order, so a list is
+# ranked again by reading its first rows
+def pair_ranking_index(connection):
+    pairs = sa.Table('product_pair', sa.MetaData(),
+        sa.Column('product_id', sa.Integer),
+        sa.Column('other_id', sa.Integer),
+        sa.Column('orders', sa.Integer),
+    )
+    sa.Index('ix_product_pair_ranking', pairs.c.product_id, pairs.c.orders.desc(), pairs.c.other_id).create(connection)
+
+# All migrations in order, migration n upgrades the schema to version n
+MIGRATIONS = [
+    initial_schema,
+    order_headers,
+    soft_delete,
+    search_indexes,
+    lookup_indexes,
+    inventory,
+    sales_rollups,
+    recommendations,
+    order_archive,
+    pair_ranking_index,
+]
+
+# Latest schema version
+HEAD = len(MIGRATIONS)
+
+# Get the version of the database schema
+def current_version(connection):
+    inspector = inspect(connection)
+    if not inspector.has_table('schema_version'):
+        # Databases from before migrations existed have the first release's tables
+        return 1 if inspector.has_table('user') else 0
+    return connection.execute(select(schema_version.c.version)).scalar() or 0
+
+# Upgrade the database to the target version, or the latest one. Returns the
+# names of the migrations that were run.
+def upgrade(target=HEAD):
+    if not 0 <= target <= HEAD:
+        raise ValueError(f'Unknown schema version: {target}')
+    with db.engine.connect() as connection:
+        version = current_version(connection)
+    if version > HEAD:
+        raise RuntimeError(f'The database schema (version {version}) is newer than this code (version {HEAD})')
+
+    applied = []
+    for number in range(version + 1, target + 1):
+        migration = MIGRATIONS[number - 1]
+        with db.engine.begin() as connection:
+            migration(connection)
+            schema_version.create(connection, checkfirst=True)
+            connection.execute(delete(schema_version))
+            connection.execute(insert(schema_version).values(version=number))
+        applied.append(migration.__name__)
+    return applied
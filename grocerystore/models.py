@@ -1,11 +1,17 @@
-from grocerystore import app, db, login_manager
+from grocerystore import db, login_manager
 from flask_login import UserMixin
-from grocerystore import bcrypt
+from grocerystore.user_cache import user_cache
 from datetime import datetime
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Use the cached user when possible, so most requests don't query the user table
+    user = user_cache.get(int(user_id))
+    if user is None:
+        user = db.session.get(User, int(user_id))
+        if user:
+            user = user_cache.put(user)
+    return user
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
@@ -17,41 +23,150 @@ class User(db.Model, UserMixin):
     
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    name = db.Column(db.String(64), nullable=False, index=True)
+    price = db.Column(db.Float, nullable=False, index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
+    # Stock available to new carts, not counting reserved stock
+    quantity = db.Column(db.Integer, nullable=False, index=True)
     manufacture_date = db.Column(db.Date, nullable=False)
+    # Soft deleted products are kept for order history but hidden everywhere else
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     cart = db.relationship('Cart', backref='product', lazy=True)
     order = db.relationship('Order', backref='product', lazy=True)
+    # Covers listing a category's products in id order
+    __table_args__ = (db.Index('ix_product_category_id', 'category_id', 'id'),)
     
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     products = db.relationship('Product', backref='category', lazy=True)
 
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False) 
+    quantity = db.Column(db.Integer, nullable=False)
+    # One line per product in a cart, also used to look up a user's cart
+    __table_args__ = (db.Index('uq_cart_user_product', 'user_id', 'product_id', unique=True),)
+
+# One checkout of a user's cart, made up of one Order row per product
+class OrderHeader(db.Model):
+    __tablename__ = 'order_header'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    datetime_ordered = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Whether the order is counted in the sales rollups yet
+    rolled_up = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    lines = db.relationship('Order', backref='header', lazy=True)
+    # Covers paging through a user's orders and summing their totals without reading the table
+    __table_args__ = (db.Index('ix_order_header_user_id', 'user_id', 'id', 'total'),)
 
+# A single product line of an order
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    header_id = db.Column(db.Integer, db.ForeignKey('order_header.id'), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
     datetime_ordered = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_order_user_id', 'user_id', 'id'),)
+
+# Stock held for a product in a user's cart, until it is ordered, removed or expires
+class Reservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    __table_args__ = (db.Index('uq_reservation_user_product', 'user_id', 'product_id', unique=True),)
+
+# One change to a product's stock, with the stock left after it. Rows are only ever added.
+class StockMovement(db.Model):
+    __tablename__ = 'stock_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    change = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # reserve, release, expire, order, adjust or import
+    reason = db.Column(db.String(16), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_stock_movement_product_id', 'product_id', 'id'),)
+
+# Recorded when a product's stock drops below the low stock threshold
+class LowStockEvent(db.Model):
+    __tablename__ = 'low_stock_event'
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    product = db.relationship('Product')
+
+# Units sold and revenue of each product, over all orders
+class ProductSales(db.Model):
+    __tablename__ = 'product_sales'
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+    product = db.relationship('Product')
+
+# Units sold and revenue of each category, counting products in the category they were in when rolled up
+class CategorySales(db.Model):
+    __tablename__ = 'category_sales'
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+    category = db.relationship('Category')
+
+# Orders, units sold and revenue of each day (UTC)
+class DailySales(db.Model):
+    __tablename__ = 'daily_sales'
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False)
+    units = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+
+# Number of checkouts that had both products, stored both ways round
+class ProductPair(db.Model):
+    __tablename__ = 'product_pair'
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True, index=True)
+    orders = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_product_pair_ranking', 'product_id', db.desc('orders'), 'other_id'),)
+
+# The products bought together with each product most often, best first
+class Recommendation(db.Model):
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    orders = db.Column(db.Integer, nullable=False)
+
+# A file of orders moved out of the order tables by 'flask orders archive'.
+# It is written once and never changed.
+class OrderSegment(db.Model):
+    __tablename__ = 'order_segment'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(64), nullable=False)
+    orders = db.Column(db.Integer, nullable=False)
+    # Range of the order ids in the file
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-#create database if it doesn't exist
-with app.app_context():
-    db.create_all()
-
-    #create admin user if it doesn't exist
-    admin = User.query.filter_by(username='admin').first()
-    if not admin:
-        hashed_password = bcrypt.generate_password_hash('admin').decode('utf-8')
-        admin = User(name='Admin', username='admin', email='admin@demo.in', password=hashed_password, is_admin=True)
-        db.session.add(admin)
-        db.session.commit()
\ No newline at end of file
+# Where a user's orders are in a segment file and what they add up to, so the
+# file is only read when the user pages back that far
+class ArchivedOrders(db.Model):
+    __tablename__ = 'archived_orders'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    segment_id = db.Column(db.Integer, db.ForeignKey('order_segment.id'), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    oldest_id = db.Column(db.Integer, nullable=False)
+    # The user's rows in the file's columns
+    header_start = db.Column(db.Integer, nullable=False)
+    line_start = db.Column(db.Integer, nullable=False)
+    line_count = db.Column(db.Integer, nullable=False)
+    segment = db.relationship('OrderSegment')
@@ -0,0 +1,92 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from flask import current_app
+from grocerystore import db, bcrypt
+from grocerystore.metrics import add_time
+
+# Raised when too many passwords are already waiting to be hashed
+class HashingBusy(Exception):
+    pass
+
+# Bcrypt is slow on purpose, so it runs on a small pool of its own threads.
+# At most PASSWORD_HASH_WORKERS hashes run at once and PASSWORD_HASH_QUEUE more
+# may wait; anything beyond that fails fast instead of tying up web workers.
+# Each app has its own pool, started on first use in each process: threads
+# don't survive a fork, so worker processes forked after a hash was made (like
+# a preloading server's workers) need a pool of their own.
+class HashingPool:
+    def __init__(self, workers, queue):
+        self.workers = workers
+        self.queue = queue
+        self.pid = None
+        self.lock = Lock()
+
+    def start(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                    self.slots = BoundedSemaphore(self.workers + self.queue)
+                    self.pid = os.getpid()
+        return self
+
+def init_app(app):
+    app.extensions['password_pool'] = HashingPool(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+
+# Hashing metrics
+stats = {
+    'hashes': 0,
+    'rejected': 0,
+    'in_flight': 0,
+    'seconds_total': 0.0,
+    'seconds_max': 0.0,
+}
+stats_lock = Lock()
+
+# Number of hashes waiting for a free worker
+def queue_depth():
+    return max(0, stats['in_flight'] - current_app.config['PASSWORD_HASH_WORKERS'])
+
+# Run a hashing function on the pool and wait for the result
+def run(function, *args):
+    pool = current_app.extensions['password_pool'].start()
+    if not pool.slots.acquire(blocking=False):
+        with stats_lock:
+            stats['rejected'] += 1
+        raise HashingBusy()
+    with stats_lock:
+        stats['in_flight'] += 1
+    start = time.perf_counter()
+    try:
+        return pool.executor.submit(function, *args).result()
+    finally:
+        elapsed = time.perf_counter() - start
+        add_time('bcrypt', elapsed)
+        with stats_lock:
+            stats['in_flight'] -= 1
+            stats['hashes'] += 1
+            stats['seconds_total'] += elapsed
+            stats['seconds_max'] = max(stats['seconds_max'], elapsed)
+        pool.slots.release()
+
+# Hash a new password
+def hash_password(password):
+    return run(bcrypt.generate_password_hash, password, current_app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
+
+# Check if a hash was made with a different cost than the configured one
+def needs_rehash(hashed_password):
+    try:
+        return int(hashed_password.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
+    except (IndexError, ValueError):
+        return True
+
+# Check a user's password, upgrading the stored hash if the cost has changed
+def check_password(user, password):
+    if not run(bcrypt.check_password_hash, user.password, password):
+        return False
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+    return True
@@ -0,0 +1,141 @@
+import logging
+from itertools import permutations
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from grocerystore import db
+from grocerystore.models import Product, Order, ProductPair, Recommendation
+from grocerystore.sales import add_to_rollup
+
+# "Frequently bought together". ProductPair is a sparse product by product
+# matrix of how many checkouts had both products, and Recommendation keeps the
+# NEIGHBOURS products with the highest counts for each product, so a page reads
+# a product's recommendations with one primary key lookup. Each checkout adds
+# its pairs, and once it is committed ranks the lists of its products again;
+# 'flask recommendations rebuild' counts every order again.
+
+logger = logging.getLogger(__name__)
+
+# Products kept for each product
+NEIGHBOURS = 10
+# Products shown on a page
+SHOWN = 4
+
+# Add a checkout of some products to the pairs, in the caller's transaction.
+# Only counts are added, so checkouts of the same products don't conflict.
+def record_checkout(product_ids):
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+    add_to_rollup(ProductPair, ['product_id', 'other_id'], [{'product_id': product_id, 'other_id': other_id, 'orders': 1} for product_id, other_id in permutations(product_ids, 2)])
+
+# The NEIGHBOURS products bought together with a product most often, as
+# (other_id, orders), read in order from the pair ranking index
+def top_pairs(product_id):
+    return db.session.execute(
+        select(ProductPair.other_id, ProductPair.orders)
+        .where(ProductPair.product_id == product_id)
+        .order_by(ProductPair.orders.desc(), ProductPair.other_id)
+        .limit(NEIGHBOURS)
+    ).all()
+
+# Update the lists of the products of a checkout, once it is committed. Each
+# list is ranked again from the committed pairs of its product, so a list left
+# behind by a failure or a concurrent checkout is put right by the next
+# checkout of its product, or by a rebuild. It runs in its own transaction and
+# never fails the checkout.
+def refresh_lists(product_ids):
+    product_ids = sorted(set(product_ids))
+    if len(product_ids) < 2:
+        return
+    try:
+        write_lists({product_id: top_pairs(product_id) for product_id in product_ids})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception('Updating the recommendations of products %s failed', product_ids)
+
+# Write the ranked lists of some products. Ranks are upserted where the
+# database can, so two writers of a list don't collide on its primary key.
+def write_lists(lists):
+    rows = [
+        {'product_id': product_id, 'rank': rank, 'other_id': other_id, 'orders': orders}
+        for product_id, items in lists.items()
+        for rank, (other_id, orders) in enumerate(items, 1)
+    ]
+    table = Recommendation.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        for product_id, items in lists.items():
+            db.session.execute(delete(table).where(table.c.product_id == product_id, table.c.rank > len(items)))
+        statement = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['product_id', 'rank'],
+            set_={'other_id': statement.excluded.other_id, 'orders': statement.excluded.orders},
+        )
+    else:
+        db.session.execute(delete(table).where(table.c.product_id.in_(list(lists))))
+        statement = insert(table)
+    if rows:
+        db.session.execute(statement, rows)
+
+# Count the pairs of every order again and rebuild the lists from them, in one
+# transaction and all in SQL. Orders are grouped into checkouts by user and
+# time, which also covers orders from before order headers. Products that are
+# deleted, and orders that are archived, are left out.
+def rebuild():
+    lines = (
+        select(Order.user_id, Order.datetime_ordered, Order.product_id)
+        .join(Product, Product.id == Order.product_id)
+        .where(Product.deleted == False)
+        .distinct()
+        .subquery()
+    )
+    first, second = lines.alias('first'), lines.alias('second')
+    pairs = ProductPair.__table__
+    ranked = select(
+        pairs.c.product_id,
+        func.row_number().over(partition_by=pairs.c.product_id, order_by=(pairs.c.orders.desc(), pairs.c.other_id)).label('rank'),
+        pairs.c.other_id,
+        pairs.c.orders,
+    ).subquery()
+    try:
+        db.session.execute(delete(Recommendation))
+        db.session.execute(delete(ProductPair))
+        db.session.execute(insert(pairs).from_select(
+            ['product_id', 'other_id', 'orders'],
+            select(first.c.product_id, second.c.product_id, func.count())
+            .join(second, (second.c.user_id == first.c.user_id) & (second.c.datetime_ordered == first.c.datetime_ordered) & (second.c.product_id != first.c.product_id))
+            .group_by(first.c.product_id, second.c.product_id),
+        ))
+        db.session.execute(insert(Recommendation.__table__).from_select(
+            ['product_id', 'rank', 'other_id', 'orders'],
+            select(ranked).where(ranked.c.rank <= NEIGHBOURS),
+        ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+# Products bought together with a product most often, best first
+def bought_with(product_id, limit=SHOWN):
+    return db.session.scalars(
+        select(Product)
+        .join(Recommendation, Recommendation.other_id == Product.id)
+        .where(Recommendation.product_id == product_id)
+        .order_by(Recommendation.rank)
+        .limit(limit)
+    ).all()
+
+# Products bought together with the products of a cart most often, adding up
+# their counts over the cart's products and leaving out the cart's own
+def bought_with_cart(product_ids, limit=SHOWN):
+    if not product_ids:
+        return []
+    return db.session.scalars(
+        select(Product)
+        .join(Recommendation, Recommendation.other_id == Product.id)
+        .where(Recommendation.product_id.in_(product_ids), Recommendation.other_id.not_in(product_ids))
+        .group_by(Product.id)
+        .order_by(func.sum(Recommendation.orders).desc(), Product.id)
+        .limit(limit)
+    ).all()
@@ -0,0 +1,151 @@
+import os
+import re
+import time
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from flask import request, make_response, current_app
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from grocerystore import db
+from grocerystore.models import Product
+
+# Rendered catalog fragments are cached under a key that includes the versions
+# of everything they show ('catalog', 'category:<id>', 'product:<id>').
+# Admin writes bump those versions, so stale fragments are simply never read again.
+
+# Cache kept in the memory of a single process, dropping the least recently used fragments
+class MemoryCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def version(self, name):
+        return self.versions.get(name, '0')
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = str(time.time_ns())
+
+# Cache kept in a directory, shared by all worker processes on the machine
+class FileCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, hashlib.sha1(repr(name).encode()).hexdigest())
+
+    # Write a file atomically, so other processes never read half of it
+    def write(self, name, data):
+        fd, temp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp, self.path(name))
+
+    def read(self, name):
+        try:
+            with open(self.path(name), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def get(self, key):
+        data = self.read(('fragment', key))
+        return pickle.loads(data) if data else None
+
+    def set(self, key, value):
+        self.write(('fragment', key), pickle.dumps(value))
+
+    def version(self, name):
+        data = self.read(('version', name))
+        return data.decode() if data else '0'
+
+    def bump(self, name):
+        self.write(('version', name), str(time.time_ns()).encode())
+
+# Cache that never stores anything
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def version(self, name):
+        return '0'
+
+    def bump(self, name):
+        pass
+
+# Create the cache backend chosen in the config
+def create_backend(config):
+    backend = config['RENDER_CACHE']
+    if backend == 'memory':
+        return MemoryCache(config['RENDER_CACHE_SIZE'])
+    if backend == 'file':
+        return FileCache(config['RENDER_CACHE_DIR'])
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'Unknown RENDER_CACHE backend: {backend}')
+
+# The cache of the current app
+render_cache = LocalProxy(lambda: current_app.extensions['render_cache'])
+
+def init_app(app):
+    app.extensions['render_cache'] = create_backend(app.config)
+    app.add_template_global(stock)
+
+# Get a fragment from the cache, rendering and caching it if needed
+def cached_fragment(key, versions, render):
+    key = tuple(key) + tuple(render_cache.version(name) for name in versions)
+    value = render_cache.get(key)
+    if value is None:
+        value = render()
+        render_cache.set(key, value)
+    return value
+
+# Mark fragments that show any of the given names as stale
+def invalidate(*names):
+    for name in names:
+        render_cache.bump(name)
+
+# Stock changes with every order, so fragments only hold a marker for it
+# which is filled in with the current quantity when the page is sent
+STOCK_MARKER = re.compile(r'<!--stock:(\d+)-->')
+
+def stock(product):
+    return Markup(f'<!--stock:{product.id}-->')
+
+# Fill in the stock markers of a page with one query
+def fill_stock(html):
+    ids = {int(product_id) for product_id in STOCK_MARKER.findall(html)}
+    if not ids:
+        return html
+    quantities = dict(db.session.query(Product.id, Product.quantity).filter(Product.id.in_(ids)).all())
+    return STOCK_MARKER.sub(lambda match: str(quantities.get(int(match.group(1)), 0)), html)
+
+# Send a page with an ETag, answering 304 if the browser already has it
+def conditional_response(html):
+    response = make_response(html)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
@@ -1,10 +1,31 @@
-from flask import render_template, redirect, url_for, flash, request
-from grocerystore.models import User, Product, Category, Cart, Order
-from grocerystore.forms import LoginForm, RegistrationForm, UpdateAccountForm, ProductForm, UpdateProductForm, CategoryForm, UpdateCategoryForm
-from grocerystore import app, db, bcrypt
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, Response, stream_with_context, current_app
+from grocerystore.models import User, Product, Category
+from grocerystore.forms import LoginForm, RegistrationForm, UpdateAccountForm, ProductForm, UpdateProductForm, CategoryForm, UpdateCategoryForm, CatalogImportForm
+from grocerystore import db
+from grocerystore import carts, checkout, deletion
+from grocerystore.catalog import get_catalog, get_category_products
+from grocerystore.catalog_io import import_products, export_products, file_format
+from grocerystore.dashboard import users_table, categories_table, products_table, stock_events_table, LOW_STOCK
+from grocerystore.history import get_order_history, get_grand_total
+from grocerystore.search import search_products, search_categories, parse_price_range
+from grocerystore.user_cache import user_cache
+from grocerystore.render_cache import cached_fragment, invalidate, fill_stock, conditional_response
+from grocerystore.passwords import hash_password, check_password, HashingBusy, stats as hashing_stats, queue_depth
+from grocerystore.metrics import prometheus_text
+from grocerystore.database import replica_reads
+from grocerystore.limits import rate_limited, failed, stats as limit_stats
+from grocerystore.delivery import stream_page
+from grocerystore.inventory import log_movements
+from grocerystore import sales
+from grocerystore.recommendations import bought_with, bought_with_cart
 from flask_login import login_user, current_user, logout_user, login_required
 from functools import wraps
 from datetime import date
+import hmac
+import io
+
+# The pages of the store, registered on the app by create_app
+main = Blueprint('main', __name__)
 
 # Decorator for admin routes
 def admin_required(f):
@@ -12,18 +33,47 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if not current_user.is_admin:
             flash('You are not authorized to view this page.', 'danger')
-            return redirect(url_for('home'))
+            return redirect(url_for('main.home'))
         return f(*args, **kwargs)
     return decorated_function
 
+# Fail fast when the password hashing queue is full
+@main.app_errorhandler(HashingBusy)
+def hashing_busy(error):
+    return 'Too many sign in requests right now. Please try again in a moment.', 503, {'Retry-After': '1'}
+
+# Request, SQL and password hashing metrics for Prometheus. They include SQL
+# statements, so scrapers must send METRICS_TOKEN, and without a token only
+# signed in admins can see them.
+@main.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+    elif not (current_user.is_authenticated and current_user.is_admin):
+        abort(404)
+    extra = [
+        ('password_hashes_total', 'counter', 'Passwords hashed or checked.', hashing_stats['hashes']),
+        ('password_hashes_rejected_total', 'counter', 'Password hashes refused because the queue was full.', hashing_stats['rejected']),
+        ('password_hash_seconds_total', 'counter', 'Time spent hashing passwords, including the wait for a worker.', hashing_stats['seconds_total']),
+        ('password_hash_seconds_max', 'gauge', 'Longest time taken by one password hash.', hashing_stats['seconds_max']),
+        ('password_hashes_in_flight', 'gauge', 'Password hashes running or waiting.', hashing_stats['in_flight']),
+        ('password_hash_queue_depth', 'gauge', 'Password hashes waiting for a worker.', queue_depth()),
+        ('rate_limited_total', 'counter', 'Requests refused because the client went over its rate limit.', limit_stats['limited']),
+        ('overloaded_total', 'counter', 'Requests refused because too many of their kind were running.', limit_stats['overloaded']),
+    ]
+    return Response(prometheus_text(extra), mimetype='text/plain; version=0.0.4')
+
 # Route for home page
-@app.route('/')
-@app.route('/home')
+@main.route('/')
+@main.route('/home')
 @login_required
+@replica_reads
 def home():
-    user = User.query.get_or_404(current_user.id)
     parameter = request.args.get('parameter')
     query = request.args.get('query')
+    after = request.args.get('after', type=int)
     parameters = {
         'category': 'Category',
         'product': 'Product',
@@ -31,58 +81,112 @@ def home():
     }
     
     if parameter == 'category':
-        categories = Category.query.filter(Category.name.like(f'%{query}%')).all()
-        return render_template('home.html', user=user, categories=categories, query=query, title='Home', parameters=parameters, parameter=parameter)
+        fragment = render_template('catalog.html', catalog=get_catalog(search_categories(query), after=after), query=query, parameter=parameter)
+        return fill_stock(render_template('home.html', fragment=fragment, query=query, title='Home', parameters=parameters, parameter=parameter))
     elif parameter == 'product':
-        return render_template('home.html', user=user, categories=Category.query.all(), name=query, query=query, title='Home', parameters=parameters, parameter=parameter)
+        results = search_products(name=query, page=request.args.get('page', 1, type=int))
+        return fill_stock(render_template('home.html', results=results, query=query, title='Home', parameters=parameters, parameter=parameter))
     elif parameter == 'price':
-        return render_template('home.html', user=user, categories=Category.query.all(), price=float(query), query=query, title='Home', parameters=parameters, parameter=parameter)
+        try:
+            min_price, max_price = parse_price_range(query)
+        except ValueError:
+            flash('Please enter a valid price!', 'danger')
+            return redirect(url_for('main.home'))
+        results = search_products(min_price=min_price, max_price=max_price, page=request.args.get('page', 1, type=int))
+        return fill_stock(render_template('home.html', results=results, query=query, title='Home', parameters=parameters, parameter=parameter))
     
-    return render_template('home.html', user=user, categories=Category.query.all(), title='Home', parameters=parameters)
+    # The catalog is the same for every shopper, so it is rendered once per catalog version
+    fragment = cached_fragment(('home', after), ['catalog'], lambda: render_template('catalog.html', catalog=get_catalog(after=after)))
+    return conditional_response(fill_stock(render_template('home.html', fragment=fragment, title='Home', parameters=parameters)))
 
 
 # Route for admin dashboard
-@app.route('/admin')
+@main.route('/admin')
 @login_required
 @admin_required
 def admin():
-    # Get all users
-    users = User.query.all()
-    # Get all products
-    products = Product.query.all()
-    # Get all categories
-    categories = Category.query.all()
-    return render_template('admin.html', users=users, products=products, categories=categories, title='Admin Dashboard')
+    # Get one page of users
+    users = users_table(request.args)
+    # Get one page of products
+    products = products_table(request.args)
+    # Get one page of categories
+    categories = categories_table(request.args)
+    # Get one page of low stock events
+    stock_events = stock_events_table(request.args)
+    return stream_page('admin.html', users=users, products=products, categories=categories, stock_events=stock_events, low_stock=LOW_STOCK, title='Admin Dashboard')
+
+# Route for sales reports, read from the sales rollups
+@main.route('/admin/sales')
+@login_required
+@admin_required
+def sales_report():
+    by = 'units' if request.args.get('by') == 'units' else 'revenue'
+    days = min(max(request.args.get('days', sales.SALES_DAYS, type=int), 1), 366)
+    daily = sales.daily_sales(days)
+    return stream_page(
+        'sales.html', title='Sales',
+        top_sellers=sales.top_sellers(by), by=by,
+        categories=sales.category_revenue(),
+        daily=daily, days=days, best_day=max(day.revenue for day in daily),
+        pending=sales.pending_orders(),
+    )
+
+# Route for importing products from a file
+@main.route('/admin/catalog/import', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_catalog():
+    form = CatalogImportForm()
+    result = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        # Read the upload as a text stream, without loading it all into memory
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8', errors='surrogateescape', newline='')
+        result = import_products(stream, file_format(upload.filename), create_categories=form.create_categories.data)
+        flash(f'Imported {result.inserted} new and {result.updated} updated products, {result.error_count} rows with errors.', 'success' if not result.error_count else 'warning')
+    return render_template('catalog/import.html', title='Import Catalog', form=form, result=result)
+
+# Route for exporting all products to a file
+@main.route('/admin/catalog/export')
+@login_required
+@admin_required
+def export_catalog():
+    format = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    mimetype = 'application/x-ndjson' if format == 'jsonl' else 'text/csv'
+    headers = {'Content-Disposition': f'attachment; filename=catalog.{format}'}
+    return Response(stream_with_context(export_products(format)), mimetype=mimetype, headers=headers)
 
 # Route for adding new user
-@app.route("/register", methods=['GET', 'POST'])
+@main.route("/register", methods=['GET', 'POST'])
+@rate_limited('auth')
 def register():
     # If user is logged in, redirect to home page
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
         # Hash password
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = hash_password(form.password.data)
         user = User(name=form.name.data, username=form.username.data, email=form.email.data, password=hashed_password)
         db.session.add(user)
         db.session.commit()
         flash(f'Account created for {form.name.data}!', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='Register', form=form)
 
 # Route for logging in
-@app.route("/login", methods=['GET', 'POST'])
+@main.route("/login", methods=['GET', 'POST'])
+@rate_limited('auth')
 def login():
     # If user is logged in, redirect to home page
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     form = LoginForm()
     if form.validate_on_submit():
         # Check if user exists
         user = User.query.filter_by(email=form.email.data).first()
         # Check if password is correct
-        if user and bcrypt.check_password_hash(user.password, form.password.data) and not user.is_admin:
+        if user and not user.is_admin and check_password(user, form.password.data):
             # Log in user
             login_user(user, remember=form.remember.data)
             # Redirect to next page if it exists
@@ -90,23 +194,25 @@ def login():
             # Flash message
             flash('Login Successful!', 'success')
             # If next page doesn't exist, redirect to home page
-            return redirect(next_page) if next_page else redirect(url_for('home'))
+            return redirect(next_page) if next_page else redirect(url_for('main.home'))
         else:
+            failed('auth')
             flash('Login Unsuccessful. Please check email and password', 'danger')
     return render_template('login.html', title='Login', form=form)
 
 # Route for logging in as admin
-@app.route("/login/admin", methods=['GET', 'POST'])
+@main.route("/login/admin", methods=['GET', 'POST'])
+@rate_limited('auth')
 def admin_login():
     # If user is logged in, redirect to home page
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     form = LoginForm()
     if form.validate_on_submit():
         # Check if user exists
         user = User.query.filter_by(email=form.email.data).first()
         # Check if password is correct and user is admin
-        if user and bcrypt.check_password_hash(user.password, form.password.data) and user.is_admin:
+        if user and user.is_admin and check_password(user, form.password.data):
             # Log in user
             login_user(user, remember=form.remember.data)
             # Redirect to next page if it exists
@@ -114,33 +220,37 @@ def admin_login():
             # Flash message
             flash('Login Successful!', 'success')
             # If next page doesn't exist, redirect to home page
-            return redirect(next_page) if next_page else redirect(url_for('home'))
+            return redirect(next_page) if next_page else redirect(url_for('main.home'))
         else:
+            failed('auth')
             flash('Login Unsuccessful. User not an admin', 'danger')
-            return redirect(url_for('admin_login'))
+            return redirect(url_for('main.admin_login'))
     return render_template('login.html', title='Admin Login', form=form, admin=True)
 
 # Route for logging out
-@app.route("/logout")
+@main.route("/logout")
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # Route for account page
-@app.route('/account', methods=['GET', 'POST'])
+@main.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
     form = UpdateAccountForm()
     # If form is submitted
     if form.validate_on_submit():
         # Update user info
-        current_user.name = form.name.data
-        current_user.username = form.username.data
-        current_user.email = form.email.data
+        user = User.query.get_or_404(current_user.id)
+        user.name = form.name.data
+        user.username = form.username.data
+        user.email = form.email.data
         # Commit changes to database
         db.session.commit()
+        # Drop the cached copy of the old user info
+        user_cache.invalidate(user.id)
         flash('Your account has been updated!', 'success')
-        return redirect(url_for('account'))
+        return redirect(url_for('main.account'))
     # If form is not submitted, populate form with user info
     elif request.method == 'GET':
         form.name.data = current_user.name
@@ -149,26 +259,27 @@ def account():
     return render_template('account.html', title='Account', form=form)
 
 # Route for deleting account
-@app.route('/account/delete', methods=['POST'])
+@main.route('/account/delete', methods=['POST'])
 @login_required
 def delete_account():
     user = User.query.get_or_404(current_user.id)
     # Check if user is admin
     if user.is_admin:
         flash('Admin account cannot be deleted!', 'danger')
-        return redirect(url_for('account'))
+        return redirect(url_for('main.account'))
     # Check if password is correct
-    if not bcrypt.check_password_hash(user.password, confirm_password):
+    if not check_password(user, request.form.get('confirm_password', '')):
         flash('Password incorrect!', 'danger')
-        return redirect(url_for('account'))
+        return redirect(url_for('main.account'))
     # Delete user
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(current_user.id)
     flash('Account deleted!', 'success')
-    return redirect(url_for('register'))
+    return redirect(url_for('main.register'))
 
 # Route for adding new category
-@app.route('/category/new', methods=['GET', 'POST'])
+@main.route('/category/new', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def new_category():
@@ -177,22 +288,29 @@ def new_category():
         category = Category(name=form.name.data)
         db.session.add(category)
         db.session.commit()
+        invalidate('catalog')
         flash('Category added!', 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
     return render_template('category/new.html', title='New Category', form=form)
 
 # Route for viewing a category
-@app.route('/category/<int:category_id>', methods=['GET'])
+@main.route('/category/<int:category_id>', methods=['GET'])
 @login_required
+@replica_reads
 def view_category(category_id):
-    # Get category by id
-    category = Category.query.get_or_404(category_id)
-    # Get all products in the category
-    products = Product.query.filter_by(category_id=category.id).all()
-    return render_template('category/view.html', title=category.name, category=category, products=products)
+    after = request.args.get('after', type=int)
+    # Render the category and one page of its products, unless it is cached already
+    def render():
+        # Get category by id
+        category = Category.query.get_or_404(category_id)
+        # Get one page of products in the category
+        products, next_after = get_category_products(category.id, after=after)
+        return category.name, render_template('category/products.html', category=category, products=products, next_after=next_after)
+    title, fragment = cached_fragment(('category', category_id, after, current_user.is_admin), [f'category:{category_id}'], render)
+    return conditional_response(fill_stock(render_template('category/view.html', title=title, fragment=fragment)))
 
 # Route for updating a category
-@app.route('/category/<int:category_id>/update', methods=['GET', 'POST'])
+@main.route('/category/<int:category_id>/update', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def update_category(category_id):
@@ -203,41 +321,40 @@ def update_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        invalidate('catalog', f'category:{category_id}')
         flash('Category updated!', 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
     elif request.method == 'GET':
         form.name.data = category.name
     return render_template('category/update.html', title='Update Category', form=form, category=category)
 
 # Get route for deleting a category
-@app.route('/category/<int:category_id>/delete', methods=['GET'])
+@main.route('/category/<int:category_id>/delete', methods=['GET'])
 @login_required
 @admin_required
 def delete_category_get(category_id):
     # Get category by id
     category = Category.query.get_or_404(category_id)
-    return render_template('category/delete.html', title='Delete Category', category=category)
+    # Show the number of products and the first few of them
+    product_count = Product.query.filter_by(category_id=category.id).count()
+    products, more = get_category_products(category.id, limit=10)
+    return render_template('category/delete.html', title='Delete Category', category=category, products=products, product_count=product_count)
 
 # Route for deleting a category
-@app.route('/category/<int:category_id>/delete', methods=['POST'])
+@main.route('/category/<int:category_id>/delete', methods=['POST'])
 @login_required
 @admin_required
 def delete_category(category_id):
     # Get category by id
     category = Category.query.get_or_404(category_id)
-    # If category has products, delete products before deleting category
-    if category.products:
-        for product in category.products:
-            db.session.delete(product)
-            db.session.commit()
-    # Delete category
-    db.session.delete(category)
-    db.session.commit()
+    # Delete the category and its products in one transaction
+    deletion.delete_category(category.id)
+    invalidate('catalog', 'products', f'category:{category_id}')
     flash('Category deleted!', 'success')
-    return redirect(url_for('admin'))
+    return redirect(url_for('main.admin'))
 
 # Route for adding a product to category
-@app.route('/category/<int:category_id>/add_product', methods=['GET', 'POST'])
+@main.route('/category/<int:category_id>/add_product', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def add_product_to_category(category_id):
@@ -252,15 +369,18 @@ def add_product_to_category(category_id):
     if form.validate_on_submit():
         product = Product(name=form.name.data, price=form.price.data, category_id=form.category_id.data, quantity=form.quantity.data, manufacture_date=form.manufacture_date.data)
         db.session.add(product)
+        db.session.flush()
+        log_movements([(product.id, product.quantity, 'adjust')], current_user.id)
         db.session.commit()
+        invalidate('catalog', f'category:{product.category_id}')
         flash('Product added!', 'success')
-        return redirect(url_for('view_category', category_id=category.id))
+        return redirect(url_for('main.view_category', category_id=category.id))
     elif request.method == 'GET':
         form.category_id.data = str(category_id)
     return render_template('product/new.html', title='Add Product', form=form, category=category)
 
 # Route for adding a new product
-@app.route('/product/new', methods=['GET', 'POST'])
+@main.route('/product/new', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def new_product():
@@ -273,21 +393,29 @@ def new_product():
     if form.validate_on_submit():
         product = Product(name=form.name.data, price=form.price.data, category_id=form.category_id.data, quantity=form.quantity.data, manufacture_date=form.manufacture_date.data)
         db.session.add(product)
+        db.session.flush()
+        log_movements([(product.id, product.quantity, 'adjust')], current_user.id)
         db.session.commit()
+        invalidate('catalog', f'category:{product.category_id}')
         flash('Product added!', 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
     return render_template('product/new.html', title='New Product', form=form)
 
 # Route for viewing a product
-@app.route('/product/<int:product_id>', methods=['GET'])
+@main.route('/product/<int:product_id>', methods=['GET'])
 @login_required
+@replica_reads
 def view_product(product_id):
     # Get product by id
     product = Product.query.get_or_404(product_id)
-    return render_template('product/view.html', title=product.name, product=product)
+    # The product page also shows the category name, so it depends on both
+    versions = [f'product:{product.id}', f'category:{product.category_id}', 'products']
+    fragment = cached_fragment(('product', product.id, current_user.is_admin), versions, lambda: render_template('product/detail.html', product=product))
+    # Recommendations change with every order, so they aren't in the fragment
+    return conditional_response(fill_stock(render_template('product/view.html', title=product.name, fragment=fragment, recommendations=bought_with(product.id))))
 
 # Route for updating a product
-@app.route('/product/<int:product_id>/update', methods=['GET', 'POST'])
+@main.route('/product/<int:product_id>/update', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def update_product(product_id):
@@ -301,14 +429,19 @@ def update_product(product_id):
     form.manufacture_date.render_kw = {'type': 'date', 'max': date.today()}
     # Populate category_id field with all categories
     if form.validate_on_submit():
+        old_category_id = product.category_id
+        old_quantity = product.quantity
         product.name = form.name.data
         product.price = form.price.data
         product.category_id = form.category_id.data
         product.quantity = form.quantity.data
         product.manufacture_date = form.manufacture_date.data
+        db.session.flush()
+        log_movements([(product.id, product.quantity - old_quantity, 'adjust')], current_user.id)
         db.session.commit()
+        invalidate('catalog', f'category:{old_category_id}', f'category:{product.category_id}', f'product:{product_id}')
         flash('Product updated!', 'success')
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
     elif request.method == 'GET':
         form.name.data = product.name
         form.price.data = product.price
@@ -318,7 +451,7 @@ def update_product(product_id):
     return render_template('product/update.html', title='Update Product', form=form, product=product)
 
 # Get route for deleting a product
-@app.route('/product/<int:product_id>/delete', methods=['GET'])
+@main.route('/product/<int:product_id>/delete', methods=['GET'])
 @login_required
 @admin_required
 def delete_product_get(product_id):
@@ -327,127 +460,116 @@ def delete_product_get(product_id):
     return render_template('product/delete.html', title='Delete Product', product=product)
 
 # Route for deleting a product
-@app.route('/product/<int:product_id>/delete', methods=['POST'])
+@main.route('/product/<int:product_id>/delete', methods=['POST'])
 @login_required
 @admin_required
 def delete_product(product_id):
     # Get product by id
     product = Product.query.get_or_404(product_id)
     # Delete product
-    db.session.delete(product)
-    db.session.commit()
+    _, category_ids = deletion.delete_products([product.id])
+    invalidate('catalog', f'product:{product_id}', *[f'category:{category_id}' for category_id in category_ids])
     flash('Product deleted!', 'success')
-    return redirect(url_for('admin'))
+    return redirect(url_for('main.admin'))
+
+# Route for deleting the products selected on the admin dashboard
+@main.route('/product/delete', methods=['POST'])
+@login_required
+@admin_required
+def delete_products():
+    product_ids = request.form.getlist('product_id', type=int)
+    if not product_ids:
+        flash('No products selected!', 'danger')
+        return redirect(url_for('main.admin'))
+    deleted, category_ids = deletion.delete_products(product_ids)
+    invalidate('catalog', *[f'product:{product_id}' for product_id in deleted], *[f'category:{category_id}' for category_id in category_ids])
+    flash(f'{len(deleted)} products deleted!', 'success')
+    return redirect(url_for('main.admin'))
 
 # Route for adding a product to cart
-@app.route('/product/<int:product_id>/add_to_cart', methods=['POST'])
+@main.route('/product/<int:product_id>/add_to_cart', methods=['POST'])
 @login_required
+@rate_limited('cart')
 def add_to_cart(product_id):
     quantity = request.form.get('quantity')
     if not quantity or quantity == '':
         flash('Please enter a quantity!', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     if not quantity.isdigit():
         flash('Please enter a valid quantity!', 'danger')
-        return redirect(url_for('home'))
-    quantity = int(quantity)
-    product = Product.query.get_or_404(product_id)
-    if quantity > product.quantity:
+        return redirect(url_for('main.home'))
+    # Add the product to the cart, or increase its quantity if it is already there
+    try:
+        carts.change_cart(current_user.id, {product_id: int(quantity)})
+    except carts.UnknownProduct:
+        abort(404)
+    except checkout.OutOfStock:
         flash('Not enough stock!', 'danger')
-        return redirect(url_for('home'))
-    # Get product by id
-    cart = Cart.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    # If product is already in cart, increase quantity
-    if cart:
-        if cart.quantity + quantity > product.quantity:
-            flash('Not enough stock!', 'danger')
-            return redirect(url_for('home'))
-        cart.quantity += quantity
-        db.session.commit()
-        flash('Product added to cart!', 'success')
-        return redirect(url_for('home'))
-    cart = Cart(user_id=current_user.id, product_id=product_id, quantity=quantity)
-    db.session.add(cart)
-    db.session.commit()
+        return redirect(url_for('main.home'))
     flash('Product added to cart!', 'success')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
 # Route for viewing cart
-@app.route('/cart')
+@main.route('/cart')
 @login_required
 def view_cart():
-    # Get all cart items
-    cart = Cart.query.filter_by(user_id=current_user.id).all()
-    total = sum([item.product.price * item.quantity for item in cart])
-    return render_template('cart.html', title='Cart', cart=cart, total=total)
+    # Get all cart items with their products
+    cart, total = carts.get_cart(current_user.id)
+    recommendations = bought_with_cart([item.product_id for item in cart])
+    return render_template('cart.html', title='Cart', cart=cart, total=total, recommendations=recommendations)
 
 # Update quantity of product in cart
-@app.route('/cart/<int:product_id>/update', methods=['POST'])
+@main.route('/cart/<int:product_id>/update', methods=['POST'])
 @login_required
+@rate_limited('cart')
 def update_cart(product_id):
     quantity = request.form.get('quantity')
     if not quantity or quantity == '':
         flash('Please enter a quantity!', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     if not quantity.isdigit():
         flash('Please enter a valid quantity!', 'danger')
-        return redirect(url_for('home'))
-    quantity = int(quantity)
-    product = Product.query.get_or_404(product_id)
-    if quantity > product.quantity:
+        return redirect(url_for('main.home'))
+    try:
+        carts.change_cart(current_user.id, {product_id: int(quantity)}, add=False)
+    except carts.UnknownProduct:
+        abort(404)
+    except checkout.OutOfStock:
         flash('Not enough stock!', 'danger')
-        return redirect(url_for('home'))
-    cart = Cart.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    cart.quantity = quantity
-    db.session.commit()
+        return redirect(url_for('main.home'))
     flash('Cart updated!', 'success')
-    return redirect(url_for('view_cart'))
+    return redirect(url_for('main.view_cart'))
 
 # Route for deleting a product from cart
-@app.route('/cart/<int:product_id>/delete', methods=['POST'])
+@main.route('/cart/<int:product_id>/delete', methods=['POST'])
 @login_required
 def remove_from_cart(product_id):
-    # Get product by id
-    cart = Cart.query.filter_by(user_id=current_user.id, product_id=product_id).first()
-    db.session.delete(cart)
-    db.session.commit()
+    carts.remove_from_cart(current_user.id, [product_id])
     flash('Product deleted from cart!', 'success')
-    return redirect(url_for('view_cart'))
+    return redirect(url_for('main.view_cart'))
 
 # Route for placing order
-@app.route('/cart/order', methods=['GET', 'POST'])
+@main.route('/cart/order', methods=['GET', 'POST'])
 @login_required
 def place_order():
-    # Get all cart items
-    cart = Cart.query.filter_by(user_id=current_user.id).all()
+    try:
+        checkout.place_order(current_user.id)
     # If cart is empty, return error
-    if not cart:
+    except checkout.EmptyCart:
         flash('Cart is empty!', 'danger')
-        return redirect(url_for('view_cart'))
-    # If cart is not empty, place order
-    for item in cart:
-        # If quantity in cart is more than quantity in stock, return error
-        if item.quantity > item.product.quantity:
-            flash('Not enough stock!', 'danger')
-            return redirect(url_for('view_cart'))
-        # If quantity in cart is less than quantity in stock, update quantity in stock
-        item.product.quantity -= item.quantity
-        # Add order to database
-        order = Order(user_id=current_user.id, product_id=item.product_id, quantity=item.quantity, price=item.product.price)
-        db.session.add(order)
-        db.session.commit()
-    # Delete all items from cart
-    for item in cart:
-        db.session.delete(item)
-        db.session.commit()
+        return redirect(url_for('main.view_cart'))
+    # If quantity in cart is more than quantity in stock, return error
+    except checkout.OutOfStock:
+        flash('Not enough stock!', 'danger')
+        return redirect(url_for('main.view_cart'))
     flash('Order placed!', 'success')
-    return redirect(url_for('orders'))
+    return redirect(url_for('main.orders'))
 
 # Route for viewing orders
-@app.route('/orders')
+@main.route('/orders')
 @login_required
 def orders():
-    # Get all orders
-    orders = Order.query.filter_by(user_id=current_user.id).all()
-    grand_total = sum([order.price * order.quantity for order in orders])
-    return render_template('orders.html', title='Orders', orders=orders, grand_total=grand_total)
\ No newline at end of file
+    # Get one page of orders and the total of all orders
+    orders, next_before = get_order_history(current_user.id, before=request.args.get('before', type=int))
+    grand_total = get_grand_total(current_user.id)
+    return render_template('orders.html', title='Orders', orders=orders, grand_total=grand_total, next_before=next_before)
\ No newline at end of file
@@ -0,0 +1,186 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import sqlalchemy as sa
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.dialects import postgresql, sqlite
+from flask import current_app
+from grocerystore import db
+from grocerystore.models import Product, Category, Order, OrderHeader, ProductSales, CategorySales, DailySales
+from grocerystore.archive import has_archive
+
+# Sales reports read from rollups of units and revenue per product, category
+# and day, never from the order table. With SALES_ROLLUPS = 'checkout' each
+# order is added to them in its own transaction; with 'batch' orders are added
+# later by 'flask sales rollup', which keeps checkouts from all updating the
+# same daily row. Either way an order is counted once, tracked by
+# OrderHeader.rolled_up.
+
+# Number of top selling products shown
+TOP_SELLERS = 10
+# Number of days shown in the daily sales
+SALES_DAYS = 30
+
+# Add rows of amounts to a rollup table, creating the rows that don't exist yet.
+# keys are the primary key columns, and every other column of the rows is added.
+def add_to_rollup(table, keys, rows):
+    if not rows:
+        return
+    table = table.__table__
+    amounts = [name for name in rows[0] if name not in keys]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        statement = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={name: table.c[name] + statement.excluded[name] for name in amounts},
+        )
+        db.session.execute(statement, rows)
+        return
+    # Other databases update first and insert the rows that weren't there
+    for row in rows:
+        where = [table.c[key] == row[key] for key in keys]
+        if not db.session.execute(update(table).where(*where).values({name: table.c[name] + row[name] for name in amounts})).rowcount:
+            db.session.execute(insert(table), [row])
+
+# Add orders to the rollups, given their lines as (day, product_id, category_id,
+# units, revenue) and their number per day
+def add_sales(lines, orders_per_day):
+    products, categories, days = defaultdict(lambda: [0, 0.0]), defaultdict(lambda: [0, 0.0]), defaultdict(lambda: [0, 0.0])
+    for day, product_id, category_id, units, revenue in lines:
+        for totals in (products[product_id], categories[category_id], days[day]):
+            totals[0] += units
+            totals[1] += revenue
+    add_to_rollup(ProductSales, ['product_id'], [{'product_id': key, 'units': units, 'revenue': revenue} for key, (units, revenue) in products.items()])
+    add_to_rollup(CategorySales, ['category_id'], [{'category_id': key, 'units': units, 'revenue': revenue} for key, (units, revenue) in categories.items()])
+    add_to_rollup(DailySales, ['day'], [
+        {'day': key, 'orders': orders_per_day.get(key, 0), 'units': units, 'revenue': revenue}
+        for key, (units, revenue) in days.items()
+    ])
+
+# Add an order being placed to the rollups, in the checkout's transaction.
+# lines maps product ids to quantities and products maps them to the products.
+def record_order(header, lines, products):
+    if current_app.config['SALES_ROLLUPS'] != 'checkout':
+        return
+    day = header.datetime_ordered.date()
+    add_sales(
+        [(day, product_id, products[product_id].category_id, quantity, products[product_id].price * quantity) for product_id, quantity in lines.items()],
+        {day: 1},
+    )
+    header.rolled_up = True
+
+# Add the orders not rolled up yet to the rollups, a batch of orders per
+# transaction, returning how many were added
+def roll_up_orders(batch_size=1000):
+    count = 0
+    while True:
+        header_ids = db.session.scalars(select(OrderHeader.id).where(OrderHeader.rolled_up == False).order_by(OrderHeader.id).limit(batch_size)).all()
+        if not header_ids:
+            return count
+        # Claim the orders first, so two batch jobs can't both count them
+        claimed = db.session.execute(
+            update(OrderHeader).where(OrderHeader.id.in_(header_ids), OrderHeader.rolled_up == False).values(rolled_up=True),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+        if claimed != len(header_ids):
+            db.session.rollback()
+            continue
+        day = func.date(Order.datetime_ordered)
+        lines = db.session.execute(
+            select(day, Order.product_id, Product.category_id, func.sum(Order.quantity), func.sum(Order.price * Order.quantity))
+            .join(Product, Product.id == Order.product_id)
+            .where(Order.header_id.in_(header_ids))
+            .group_by(day, Order.product_id, Product.category_id)
+            .execution_options(include_deleted=True)
+        ).all()
+        header_day = func.date(OrderHeader.datetime_ordered)
+        orders_per_day = dict(db.session.execute(select(header_day, func.count()).where(OrderHeader.id.in_(header_ids)).group_by(header_day)).all())
+        add_sales([(as_date(line[0]), *line[1:]) for line in lines], {as_date(day): orders for day, orders in orders_per_day.items()})
+        db.session.commit()
+        count += len(header_ids)
+
+# SQLite gives dates as text
+def as_date(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+# Rebuild the rollups from every order, in one transaction. The order lines are
+# read once, grouped by day and product into a temporary table, and the three
+# rollups are summed from that, all in SQL. Checkouts that commit while it runs
+# on a database other than SQLite may be missed, so run it while the store is quiet.
+# Archived orders aren't in the order tables any more, so it refuses to run once
+# there are any.
+def backfill():
+    if has_archive():
+        raise RuntimeError('Some orders are archived, rebuilding the sales rollups would leave them out')
+    staging = sa.Table('sales_staging', sa.MetaData(),
+        sa.Column('day', sa.Date),
+        sa.Column('product_id', sa.Integer),
+        sa.Column('category_id', sa.Integer),
+        sa.Column('units', sa.Integer),
+        sa.Column('revenue', sa.Float),
+        prefixes=['TEMPORARY'],
+    )
+    connection = db.session.connection()
+    try:
+        staging.create(connection)
+        for rollup in (ProductSales, CategorySales, DailySales):
+            db.session.execute(delete(rollup))
+
+        day = func.date(Order.datetime_ordered)
+        db.session.execute(insert(staging).from_select(
+            ['day', 'product_id', 'category_id', 'units', 'revenue'],
+            select(day, Order.product_id, Product.category_id, func.sum(Order.quantity), func.sum(Order.price * Order.quantity))
+            .join(Product, Product.id == Order.product_id)
+            .group_by(day, Order.product_id, Product.category_id),
+        ))
+        db.session.execute(insert(ProductSales.__table__).from_select(
+            ['product_id', 'units', 'revenue'],
+            select(staging.c.product_id, func.sum(staging.c.units), func.sum(staging.c.revenue)).group_by(staging.c.product_id),
+        ))
+        db.session.execute(insert(CategorySales.__table__).from_select(
+            ['category_id', 'units', 'revenue'],
+            select(staging.c.category_id, func.sum(staging.c.units), func.sum(staging.c.revenue)).group_by(staging.c.category_id),
+        ))
+        header_day = func.date(OrderHeader.datetime_ordered)
+        orders = select(header_day.label('day'), func.count().label('orders')).group_by(header_day).subquery()
+        db.session.execute(insert(DailySales.__table__).from_select(
+            ['day', 'orders', 'units', 'revenue'],
+            select(staging.c.day, func.coalesce(func.max(orders.c.orders), 0), func.sum(staging.c.units), func.sum(staging.c.revenue))
+            .outerjoin(orders, orders.c.day == staging.c.day)
+            .group_by(staging.c.day),
+        ))
+        db.session.execute(update(OrderHeader).values(rolled_up=True), execution_options={'synchronize_session': False})
+        staging.drop(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+# Products with the most revenue, or the most units sold, as (product, units, revenue)
+def top_sellers(by='revenue', limit=TOP_SELLERS):
+    column = ProductSales.units if by == 'units' else ProductSales.revenue
+    return db.session.execute(
+        select(Product, ProductSales.units, ProductSales.revenue)
+        .join(ProductSales.product)
+        .order_by(column.desc(), Product.id)
+        .limit(limit)
+    ).all()
+
+# Revenue of every category, highest first, as (category, units, revenue)
+def category_revenue():
+    return db.session.execute(
+        select(Category, CategorySales.units, CategorySales.revenue)
+        .join(CategorySales.category)
+        .order_by(CategorySales.revenue.desc(), Category.id)
+    ).all()
+
+# Sales of the last days up to today (UTC), oldest first, with days without sales as zeros
+def daily_sales(days=SALES_DAYS, today=None):
+    today = today or datetime.utcnow().date()
+    first = today - timedelta(days=days - 1)
+    rows = {row.day: row for row in DailySales.query.filter(DailySales.day >= first, DailySales.day <= today)}
+    return [rows.get(first + timedelta(days=n)) or DailySales(day=first + timedelta(days=n), orders=0, units=0, revenue=0.0) for n in range(days)]
+
+# Number of orders not in the rollups yet
+def pending_orders():
+    return db.session.scalar(select(func.count()).select_from(OrderHeader).where(OrderHeader.rolled_up == False))
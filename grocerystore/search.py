@@ -0,0 +1,93 @@
+from collections import namedtuple
+from sqlalchemy import select, table, column, literal_column, text
+from grocerystore import db
+from grocerystore.models import Category, Product
+
+# Number of search results shown per page
+RESULTS_PER_PAGE = 20
+# Trigram indexes can't match anything shorter than this
+MIN_MATCH_LENGTH = 3
+
+# One page of ranked search results
+SearchPage = namedtuple('SearchPage', ['products', 'page', 'has_next'])
+
+# Full text indexes over product and category names (SQLite FTS5 virtual tables).
+# They are external content tables, so they only store the index and are kept
+# in sync with their source tables by triggers.
+product_search = table('product_search', column('rowid'), column('rank'))
+category_search = table('category_search', column('rowid'), column('rank'))
+
+# DDL for a trigram full text index over the name column of a table
+def search_index_ddl(source):
+    index = f'{source}_search'
+    return [
+        f"CREATE VIRTUAL TABLE {index} USING fts5(name, content='{source}', content_rowid='id', tokenize='trigram')",
+        f"CREATE TRIGGER {index}_insert AFTER INSERT ON {source} BEGIN "
+        f"INSERT INTO {index}(rowid, name) VALUES (new.id, new.name); END",
+        f"CREATE TRIGGER {index}_delete AFTER DELETE ON {source} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.id, old.name); END",
+        f"CREATE TRIGGER {index}_update AFTER UPDATE OF name ON {source} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.id, old.name); "
+        f"INSERT INTO {index}(rowid, name) VALUES (new.id, new.name); END",
+        # Index the rows that already exist
+        f"INSERT INTO {index}({index}) VALUES ('rebuild')",
+    ]
+
+# Check if the full text indexes can be used for this query
+def use_search_index(query):
+    if db.engine.dialect.name != 'sqlite' or len(query) < MIN_MATCH_LENGTH:
+        return False
+    return db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'product_search'")).first() is not None
+
+# Quote user input so it is matched as a plain substring
+def match_expression(query):
+    return '"' + query.replace('"', '""') + '"'
+
+# Select ids and ranks of every row matching the query in a full text index.
+# The caller filters, orders and pages them, so no match is left out.
+def match_ids(index, query):
+    return select(index.c.rowid.label('id'), index.c.rank.label('rank')).where(
+        literal_column(index.name).op('MATCH')(match_expression(query))
+    )
+
+# Parse a price filter, either a maximum price ("50") or a range ("10-50")
+def parse_price_range(value):
+    low, _, high = (value or '').partition('-')
+    if not _:
+        return None, float(low)
+    return (float(low) if low.strip() else None), (float(high) if high.strip() else None)
+
+# Search products by name and price, ranked by how well the name matches
+def search_products(name=None, min_price=None, max_price=None, page=1, per_page=RESULTS_PER_PAGE):
+    query = Product.query
+    order = []
+    name = (name or '').strip()
+    if name and use_search_index(name):
+        matches = match_ids(product_search, name).subquery()
+        query = query.join(matches, Product.id == matches.c.id)
+        order.append(matches.c.rank)
+    elif name:
+        # Short queries can only be matched as a name prefix
+        query = query.filter(Product.name.like(f'{name}%'))
+    if min_price is not None:
+        query = query.filter(Product.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Product.price <= max_price)
+    if not order:
+        order.append(Product.price)
+    products = query.order_by(*order, Product.id).offset((page - 1) * per_page).limit(per_page + 1).all()
+    return SearchPage(products[:per_page], page, len(products) > per_page)
+
+# Filter a product query to every product whose name matches the search
+def filter_product_name(query, name):
+    name = (name or '').strip()
+    if name and use_search_index(name):
+        return query.filter(Product.id.in_(select(match_ids(product_search, name).subquery().c.id)))
+    return query.filter(Product.name.like(f'{name}%'))
+
+# Get a query for the categories whose name matches the search
+def search_categories(name):
+    name = (name or '').strip()
+    if name and use_search_index(name):
+        return Category.query.filter(Category.id.in_(select(match_ids(category_search, name).subquery().c.id)))
+    return Category.query.filter(Category.name.like(f'%{name}%'))
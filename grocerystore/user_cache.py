@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask import current_app
+from flask_login import UserMixin
+from werkzeug.local import LocalProxy
+
+# The user fields needed to authenticate a request and render the layout.
+# It is a plain object, so it can be shared between requests and is never
+# attached to a database session.
+class CachedUser(UserMixin):
+    def __init__(self, user):
+        self.id = user.id
+        self.name = user.name
+        self.username = user.username
+        self.email = user.email
+        self.is_admin = user.is_admin
+
+# An LRU cache of logged in users that also expires entries after a time to live.
+# Every worker process has its own cache, so the time to live bounds how long a
+# change made through another process can go unnoticed.
+class UserCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.users = OrderedDict()
+        self.lock = Lock()
+
+    # Get a cached user, or None if it isn't cached or has expired
+    def get(self, user_id):
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < time.monotonic():
+                del self.users[user_id]
+                return None
+            self.users.move_to_end(user_id)
+            return user
+
+    # Cache a user loaded from the database
+    def put(self, user):
+        cached = CachedUser(user)
+        with self.lock:
+            self.users[user.id] = (cached, time.monotonic() + self.ttl)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+        return cached
+
+    # Remove a user after it was changed or deleted
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+# The user cache of the current app
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])
+
+def init_app(app):
+    app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])